@@ -0,0 +1,154 @@
+# Approach planner for controller_node. Scores a grid of places to stand
+# behind the ball, and headings to strike from, all at once with numpy.
+# The score is the time the drive model predicts for the whole attempt
+# (turn, drive, turn to face the ball, approach) plus a penalty for
+# striking off the line to the goal. The grid is refined around the best
+# plan while the time budget lasts.
+
+import time
+import numpy as np
+from collections import namedtuple
+from drive_common import drive_settings
+
+# a plan in the robot frame: turn (degrees clockwise) and drive (inches) to
+# the approach point, from where the ball is struck with the robot heading
+# heading_offset degrees counterclockwise of facing the ball. misalignment is
+# the angle in degrees between that strike heading and the ball to goal
+# line, time the predicted seconds including facing and approaching the
+# ball. Plans that are not aligned only get closer to a place a strike can
+# be made from
+Plan = namedtuple('Plan', ['turn', 'drive', 'heading_offset', 'misalignment', 'time',
+                           'cost', 'aligned'])
+
+# speeds and ramps of DriveNode's closed loop moves, mm and seconds, and the
+# seconds each move costs on top of its profile
+DriveModel = namedtuple('DriveModel', ['drive_speed', 'turn_speed', 'accel', 'decel',
+                                       'wheel_base', 'move_overhead'])
+default_drive_model = DriveModel(float(drive_settings.drive_speed),
+                                 float(drive_settings.turn_speed),
+                                 drive_settings.move_accel, drive_settings.move_decel,
+                                 drive_settings.wheel_base, 0.15)
+
+# function to return the seconds a trapezoidal profile takes over distance
+# (any array shape) with cruise speed speed, ramping at accel and decel
+def move_time(distance, speed, accel, decel, overhead):
+    distance = np.abs(distance)
+    ramp = speed * speed / (2 * accel) + speed * speed / (2 * decel)
+    cruise = speed / accel + speed / decel + (distance - ramp) / speed
+    peak = np.sqrt(2 * distance * accel * decel / (accel + decel))
+    short = peak / accel + peak / decel
+    seconds = np.where(distance >= ramp, cruise, short)
+    # moves too small for DriveNode to bother with cost nothing
+    return np.where(distance > 0.1, seconds + overhead, 0.0)
+
+def wrap_angle(angle):
+    return (angle + np.pi) % (2 * np.pi) - np.pi
+
+class ApproachPlanner():
+    """Pick the quickest well aligned way to get behind the ball"""
+    def __init__(self, strike_dist=20.0, clearance=12.0, hit_width=5.0,
+                 max_misalignment=20.0, alignment_weight=4.0, budget=0.001,
+                 drive_model=default_drive_model):
+        self.strike_dist = strike_dist          # inches from the ball the approach ends
+        self.clearance = clearance              # inches the path keeps from the ball
+        self.hit_width = hit_width              # inches the strike can be off center
+        self.max_misalignment = np.radians(max_misalignment)
+        self.alignment_weight = alignment_weight    # seconds per radian squared off the goal
+        self.budget = budget
+        self.model = drive_model
+        self.radii = np.arange(self.strike_dist, self.strike_dist + 25.0, 2.5)
+        self.angles = np.radians(np.arange(-90, 91, 10.0))
+        self.offsets = np.radians(np.arange(-15, 16, 5.0))
+
+    def drive_seconds(self, inches):
+        m = self.model
+        return move_time(inches * 25.4, m.drive_speed, m.accel, m.decel, m.move_overhead)
+
+    def turn_seconds(self, radians):
+        m = self.model
+        return move_time(radians * m.wheel_base / 2.0, m.turn_speed, m.accel, m.decel,
+                         m.move_overhead)
+
+    def score(self, ball, goal, radii, angles, offsets, aligned=True):
+        """
+        Cost of every (radius, angle, offset) candidate. angles are measured
+        around the ball from the goal to ball direction, so 0 is straight
+        behind the ball. Without aligned, candidates that can't strike
+        towards the goal are allowed too
+        """
+        radius = radii[:, None, None]
+        behind = np.arctan2(ball[1] - goal[1], ball[0] - goal[0])
+        around = (behind + angles)[None, :, None]
+        offset = offsets[None, None, :]
+        point_x = ball[0] + radius * np.cos(around)
+        point_y = ball[1] + radius * np.sin(around)
+        # turn to the point, drive there, turn to the strike heading
+        to_point = np.arctan2(point_y, point_x)
+        drive = np.hypot(point_x, point_y)
+        facing = np.arctan2(ball[1] - point_y, ball[0] - point_x)
+        heading = facing + offset
+        face_turn = wrap_angle(heading - to_point)
+        approach = np.maximum(radius * np.cos(offset) - self.strike_dist, 0.0)
+        seconds = (self.turn_seconds(to_point) + self.drive_seconds(drive) +
+                   self.turn_seconds(face_turn) + self.drive_seconds(approach))
+        # the strike goes along the heading, it has to hit the ball and
+        # should send it towards the goal
+        goal_line = np.arctan2(goal[1] - ball[1], goal[0] - ball[0])
+        misalignment = np.abs(wrap_angle(heading - goal_line))
+        miss = radius * np.abs(np.sin(offset))
+        # the path from the robot to the point must not run through the ball,
+        # or get closer to it than the robot already is
+        along = np.clip((ball[0] * point_x + ball[1] * point_y) / np.maximum(drive * drive, 1e-9),
+                        0.0, 1.0)
+        passing = np.hypot(ball[0] - along * point_x, ball[1] - along * point_y)
+        feasible = passing >= min(self.clearance, np.hypot(ball[0], ball[1]) - 1e-6)
+        if aligned:
+            feasible = (feasible & (misalignment <= self.max_misalignment) &
+                        (miss <= self.hit_width))
+        cost = np.where(feasible, seconds + self.alignment_weight * misalignment ** 2, np.inf)
+        return np.broadcast_arrays(cost, to_point, drive, misalignment, seconds)
+
+    def plan(self, ball, goal):
+        """
+        Best Plan to strike the ball at ball towards goal, both (x, y) inches
+        in the robot frame (x forward, y left). When the robot can't get
+        behind the ball in one straight drive (the ball is in the way) the
+        best unaligned plan is returned, to be planned again from its end
+        """
+        start = time.time()
+        plan = self.search(ball, goal, start, True)
+        if plan is None:
+            plan = self.search(ball, goal, start, False)
+        return plan
+
+    def search(self, ball, goal, start, aligned):
+        radii, angles, offsets = self.radii, self.angles, self.offsets
+        best = None
+        best_cost = np.inf
+        while True:
+            arrays = self.score(ball, goal, radii, angles, offsets, aligned)
+            cost = arrays[0]
+            index = np.unravel_index(np.argmin(cost), cost.shape)
+            if cost[index] < best_cost:
+                best_cost = cost[index]
+                best = [array[index] for array in arrays]
+                best_params = (radii[index[0]], angles[index[1]], offsets[index[2]])
+            # refine around the best candidate at half the spacing while
+            # another round still fits in the budget
+            if best is None or time.time() - start > self.budget / 2:
+                break
+            radius, angle, offset = best_params
+            radius_step = (radii[1] - radii[0]) / 2.0 if len(radii) > 1 else 1.0
+            angle_step = (angles[1] - angles[0]) / 2.0 if len(angles) > 1 else np.radians(2)
+            offset_step = (offsets[1] - offsets[0]) / 2.0 if len(offsets) > 1 else np.radians(2)
+            if angle_step < np.radians(0.5):
+                break
+            radii = np.maximum(radius + radius_step * np.arange(-2, 3), self.strike_dist)
+            angles = angle + angle_step * np.arange(-2, 3)
+            offsets = offset + offset_step * np.arange(-2, 3)
+        if best is None:
+            return None
+        cost, to_point, drive, misalignment, seconds = best
+        # turns are clockwise for positive degrees, like the motion goals
+        return Plan(-np.degrees(to_point), drive, np.degrees(best_params[2]),
+                    np.degrees(misalignment), seconds, cost, aligned)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+# Replay recorded frames through the camera_node pipeline without a camera or
+# roscore and report per stage latency, frames per second and peak memory.
+# The objectPose output of every frame can be saved as a golden file and
+# later runs compared against it. The processing budget is off unless --budget
+# is given, as it picks quality levels from this machine's timings, so budget
+# runs are not saved as or compared with golden output.
+#
+# usage: benchmark_camera.py <directory of images | video file>
+#            [--fps 25] [--save-golden file] [--golden file] [--budget]
+
+import argparse
+import json
+import resource
+import time
+import numpy as np
+import rospy
+import camera_node
+from camera_node import CameraNode
+from pyramid_tradeoff import load_frames
+
+stage_names = ['segment', 'ball', 'goal', 'detect', 'pose', 'total']
+golden_fields = ['ball_in_view', 'ball_center_x', 'ball_width', 'ball_distance',
+                 'goal_in_view', 'goal_center_x', 'goal_width', 'goal_distance',
+                 'ball_goal_lined_up_maybe', 'ball_goal_lined_up']
+# allowed difference from the golden output, fields not listed must match exactly
+golden_tolerance = {'ball_center_x': 2, 'ball_width': 2, 'ball_distance': 1.0,
+                    'goal_center_x': 2, 'goal_width': 2, 'goal_distance': 1.0}
+
+# function to wrap a step so its run time is appended to times
+def timed(function, times):
+    def run(*args):
+        start = time.time()
+        result = function(*args)
+        times.append(time.time() - start)
+        return result
+    return run
+
+# function to run every frame through CameraNode._process_image, timing its
+# steps by wrapping them on the node, and feeding the processing budget the
+# way _handle_frame does. Returns the times, the objectPose of every frame
+# and the quality level each frame was processed at
+def run_pipeline(node, frames, fps):
+    times = dict((name, []) for name in stage_names)
+    node._segment_image = timed(node._segment_image, times['segment'])
+    node.findBall = timed(node.findBall, times['ball'])
+    node.findGoalInMask = timed(node.findGoalInMask, times['goal'])
+    node._run_detectors = timed(node._run_detectors, times['detect'])
+    node._build_pose = timed(node._build_pose, times['pose'])
+    poses = []
+    levels = []
+    for index, frame in enumerate(frames):
+        stamp = rospy.Time.from_sec(index / float(fps))
+        if node.budget is not None:
+            levels.append(node.budget.index)
+        start = time.time()
+        node._process_image(frame, stamp)
+        seconds = time.time() - start
+        if node.budget is not None:
+            node.budget.record(seconds)
+        times['total'].append(seconds)
+        poses.append(dict((field, getattr(node.lastPose, field)) for field in golden_fields))
+    return times, poses, levels
+
+# function to return the frames whose output differs from the golden output
+def compare_golden(poses, golden):
+    mismatches = []
+    if len(poses) != len(golden):
+        print "Golden output has %d frames, replayed %d" % (len(golden), len(poses))
+    for index, (pose, expected) in enumerate(zip(poses, golden)):
+        for field in golden_fields:
+            if abs(pose[field] - expected[field]) > golden_tolerance.get(field, 0):
+                mismatches.append((index, field, expected[field], pose[field]))
+    return mismatches
+
+def print_report(times, levels, num_frames, setup_time, memory_before, memory_after):
+    print "%d frames, node setup %.2f s" % (num_frames, setup_time)
+    print "stage      mean ms   p50 ms   p90 ms   p99 ms   max ms"
+    for name in stage_names:
+        # the goal is only looked for every goalEvery frames
+        if not times[name]:
+            continue
+        ms = 1000 * np.array(times[name])
+        print "%-8s  %8.2f %8.2f %8.2f %8.2f %8.2f" % (
+                name, ms.mean(), np.percentile(ms, 50), np.percentile(ms, 90),
+                np.percentile(ms, 99), ms.max())
+    print "throughput %.1f frames/s" % (num_frames / sum(times['total']))
+    if levels:
+        print "quality levels: " + ', '.join('%d: %d frames' % (level, levels.count(level))
+                                             for level in sorted(set(levels)))
+    # ru_maxrss is in kilobytes on linux
+    print "peak memory %.1f MB (%.1f MB while processing)" % (
+            memory_after / 1024.0, (memory_after - memory_before) / 1024.0)
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline camera_node benchmark')
+    parser.add_argument('frames', help='directory of images or a video file')
+    parser.add_argument('--fps', type=float, default=25, help='rate the frames were recorded at')
+    parser.add_argument('--save-golden', help='write the per frame output to this file')
+    parser.add_argument('--golden', help='compare the per frame output with this file')
+    parser.add_argument('--budget', action='store_true',
+                        help='let the processing budget pick the quality level, not golden compared')
+    args = parser.parse_args()
+
+    frames = load_frames(args.frames)
+    if not frames:
+        print "No frames found in", args.frames
+        return
+    # the budget picks levels from wall clock time, which golden output can't depend on
+    camera_node.useProcessingBudget = args.budget
+    start = time.time()
+    node = CameraNode(start_node=False)
+    setup_time = time.time() - start
+    memory_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times, poses, levels = run_pipeline(node, frames, args.fps)
+    memory_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print_report(times, levels, len(frames), setup_time, memory_before, memory_after)
+
+    if args.budget and (args.save_golden or args.golden):
+        print "Golden output is not saved or compared with --budget"
+        return
+    if args.save_golden:
+        with open(args.save_golden, 'w') as golden_file:
+            json.dump(poses, golden_file, indent=1)
+        print "Saved golden output to", args.save_golden
+    if args.golden:
+        with open(args.golden) as golden_file:
+            mismatches = compare_golden(poses, json.load(golden_file))
+        frames_off = len(set(index for index, _, _, _ in mismatches))
+        print "%d of %d frames differ from the golden output" % (frames_off, len(poses))
+        for index, field, expected, actual in mismatches[:20]:
+            print "  frame %d %s: expected %s, got %s" % (index, field, expected, actual)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+# Run drive_node against create_emulator.py and report service latency, how
+# closely driveDist and turnAngle land and how many serial writes the
+# driveCommand topic turns into. Needs a running roscore but no robot.
+#
+# usage: benchmark_drive.py [--calls 200] [--latency 0.0] [--baud 115200]
+#            [--error-rate 0.0]
+
+import os
+import sys
+import math
+import time
+import argparse
+import subprocess
+import numpy as np
+import rospy
+from robotics_project.srv import requestAngle, requestSensors, driveDist, turnAngle
+from robotics_project.msg import driveCommand
+from create_emulator import Create2Emulator
+
+# function to call a service calls times, returning the seconds per call
+def time_calls(service, calls, *args):
+    times = []
+    for _ in range(calls):
+        start = time.time()
+        service(*args)
+        times.append(time.time() - start)
+    return times
+
+def print_latency(name, times):
+    ms = 1000 * np.array(times)
+    print "%-24s %8.2f %8.2f %8.2f %8.2f %8.2f" % (
+            name, ms.mean(), np.percentile(ms, 50), np.percentile(ms, 90),
+            np.percentile(ms, 99), ms.max())
+
+# function to run a move and compare what drive_node reports with the emulator
+def check_move(emulator, name, service, amount, truth):
+    before = truth(emulator)
+    start = time.time()
+    response = service(amount, rospy.Time(0))
+    seconds = time.time() - start
+    actual = truth(emulator) - before
+    print "%-10s target %7.2f  reported %7.2f  actual %7.2f  error %6.2f  %.2f s" % (
+            name, amount, response.achieved, actual, actual - amount, seconds)
+
+def driven_inches(emulator):
+    return (emulator.wheel_mm[0] + emulator.wheel_mm[1]) / 2.0 / 25.4
+
+def turned_degrees(emulator):
+    # turnAngle turns clockwise for positive degrees
+    return -math.degrees(emulator.heading)
+
+# function to publish driveCommands as fast as possible for duration seconds,
+# returns how many were published and how many drive commands reached the robot
+def flood_commands(emulator, publisher, duration, changing):
+    writes_before = emulator.opcode_counts.get(145, 0)
+    published = 0
+    end = time.time() + duration
+    while time.time() < end:
+        velocity = 100 + (published % 50 if changing else 0)
+        publisher.publish(driveCommand(velocity=velocity, rotation=0))
+        published += 1
+    publisher.publish(driveCommand(velocity=0, rotation=0))
+    rospy.sleep(0.2)
+    return published, emulator.opcode_counts.get(145, 0) - writes_before
+
+def main():
+    parser = argparse.ArgumentParser(description='drive_node benchmark against the emulator')
+    parser.add_argument('--calls', type=int, default=200, help='calls per service')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='emulated serial latency in seconds')
+    parser.add_argument('--baud', type=int, default=115200, help='emulated baud rate')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='chance of corrupting each byte the robot sends')
+    parser.add_argument('--flood-time', type=float, default=2.0,
+                        help='seconds to flood driveCommand for')
+    args = parser.parse_args(rospy.myargv()[1:])
+
+    emulator = Create2Emulator(args.latency, args.baud, args.error_rate)
+    drive_node = subprocess.Popen([sys.executable,
+                                   os.path.join(os.path.dirname(__file__), 'drive_node.py'),
+                                   '_port:=' + emulator.slave_name,
+                                   '_baudrate:=%d' % args.baud])
+    try:
+        rospy.init_node('benchmark_drive', anonymous=True)
+        rospy.wait_for_service('requestSensors', 30)
+        angle_request = rospy.ServiceProxy('requestAngle', requestAngle, persistent=True)
+        sensors_request = rospy.ServiceProxy('requestSensors', requestSensors,
+                                             persistent=True)
+        distance_request = rospy.ServiceProxy('driveDist', driveDist)
+        turn_request = rospy.ServiceProxy('turnAngle', turnAngle)
+        publisher = rospy.Publisher('driveCommand', driveCommand, queue_size=1)
+        rospy.sleep(1.0)
+
+        print "service                   mean ms   p50 ms   p90 ms   p99 ms   max ms"
+        print_latency('requestAngle', time_calls(angle_request, args.calls))
+        print_latency('requestSensors streamed', time_calls(sensors_request, args.calls,
+                                                            [43, 44]))
+        # battery charge and capacity aren't streamed, so they are a real query
+        print_latency('requestSensors queried', time_calls(sensors_request, args.calls,
+                                                           [25, 26]))
+
+        check_move(emulator, 'driveDist', distance_request, 24, driven_inches)
+        check_move(emulator, 'turnAngle', turn_request, 90, turned_degrees)
+
+        for changing in (True, False):
+            published, writes = flood_commands(emulator, publisher, args.flood_time, changing)
+            print "driveCommand %s: %d published (%.0f/s), %d serial writes (%.1f/s)" % (
+                    'changing' if changing else 'repeated', published,
+                    published / args.flood_time, writes, writes / args.flood_time)
+        print "emulator:", emulator.stats()
+    finally:
+        drive_node.terminate()
+        drive_node.wait()
+        emulator.close()
+
+if __name__ == "__main__":
+    main()
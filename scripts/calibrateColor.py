@@ -1,22 +1,35 @@
+#!/usr/bin/env python
+
+# Color calibration for camera_node.
+#
+# usage: calibrateColor.py
+#            pick the color under the center pixel after a countdown and track it
+#        calibrateColor.py <ball|goal> [colors.yaml] [num frames]
+#            drag a box over the object, press c to collect hsv histograms over
+#            num frames (default 300) and write the tightest thresholds that
+#            cover it to colors.yaml (default config/colors.yaml), then ask a
+#            running camera_node to reload them
+
+import os
+import sys
 import numpy as np
 import cv2
 import time
+import yaml
 from code import interact
 
-# Function to return 2-d binary of 3-d matrix where pixels == true
-# if they are within the specified range from the corosponding 
+# fraction of the selected pixels the thresholds have to cover
+coverage = 0.98
+default_color_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  '..', 'config', 'colors.yaml')
+
+# Function to return 2-d binary of 3-d matrix where pixels == 255
+# if they are strictly within the specified range from the corosponding 
 # value in the vector 'values', which must be of length 3
 def threshold3d(image, values, allowedDiff):
-	image[:, :, 0] = np.logical_and(\
-					image[:, :, 0] > (values[0] - allowedDiff),\
-					image[:, :, 0] < (values[0] + allowedDiff))
-	image[:, :, 1] = np.logical_and(\
-					image[:, :, 1] > (values[1] - allowedDiff),\
-					image[:, :, 1] < (values[1] + allowedDiff))
-	image[:, :, 2] = np.logical_and(\
-					image[:, :, 2] > (values[2] - allowedDiff),\
-					image[:, :, 2] < (values[2] + allowedDiff))
-	return np.logical_and(image[:, :, 0], image[:, :, 1], image[:, :, 2])	
+	lower = tuple(int(value) - allowedDiff + 1 for value in values)
+	upper = tuple(int(value) + allowedDiff - 1 for value in values)
+	return cv2.inRange(image, lower, upper)
 
 # Function to select the color in the middle of the image
 def selectCenterColor(frame):
@@ -67,109 +80,243 @@ def processFrame(frame, colorWeWant):
     return (frame)
 
 
-##############   Main   ##############  
-
-cap = cv2.VideoCapture()
-cap.open(0)
-#cap.open('ball.avi')
-
-# Find mid point
-ret, frame = cap.read()
-mid = [frame.shape[0]/2, frame.shape[1]/2]
-
-# Display frame with color to be selected blacked out
-# so the user can see what's about to be selected
-#while(True):
-for i in range(300):
-    time.sleep(.01)
-
-    # Capture frame-by-frame
+# Function to return the smallest [low, high] bin range holding
+# the given fraction of a histogram
+def tightestRange(histogram, fraction):
+    cumulative = np.cumsum(histogram)
+    before = cumulative - histogram
+    ends = np.searchsorted(cumulative, before + fraction * cumulative[-1])
+    widths = np.where(ends < len(histogram), ends - np.arange(len(histogram)), len(histogram))
+    low = np.argmin(widths)
+    return low, min(ends[low], len(histogram) - 1)
+
+class HsvHistogram():
+    """Per channel hsv histograms accumulated over many frames"""
+    def __init__(self):
+        self.counts = [np.zeros(256, np.int64) for channel in range(3)]
+
+    def add(self, hsvRegion):
+        for channel in range(3):
+            self.counts[channel] += np.bincount(hsvRegion[:, :, channel].ravel(),
+                                                minlength=256)
+
+    def thresholds(self, fraction):
+        """Return (color, threshold) so color +- threshold covers fraction of the pixels"""
+        # each channel covers its share so the three together cover fraction
+        perChannel = fraction ** (1 / 3.0)
+        color = []
+        threshold = []
+        for channel, counts in enumerate(self.counts):
+            if channel == 0:
+                low, high = self.hueRange(counts[:180], perChannel)
+            else:
+                low, high = tightestRange(counts, perChannel)
+            center = (low + high) // 2
+            color.append(int(center))
+            threshold.append(int(max(center - low, high - center)))
+        return color, threshold
+
+    def hueRange(self, counts, fraction):
+        """Tightest hue range, hue wraps at 180 but inRange can't, so a
+        range across 0 is cut down to the side holding more pixels"""
+        low, high = tightestRange(np.concatenate([counts, counts]), fraction / 2)
+        if high - low >= 180:
+            return tightestRange(counts, fraction)
+        if high < 180 or low >= 180:
+            return low % 180, high % 180
+        print "Hue range %d-%d wraps around 0, keeping the larger side" % (low, high - 180)
+        if counts[low:].sum() >= counts[:high - 179].sum():
+            return low, 179
+        return 0, high - 180
+
+# Function to let the user drag a box in the 'frame' window, returns a
+# dict whose 'box' is (x, y, w, h) once something has been selected
+def selectRegion():
+    selection = {'start': None, 'box': None}
+    def onMouse(event, x, y, flags, param):
+        if event == cv2.EVENT_LBUTTONDOWN:
+            selection['start'] = (x, y)
+        elif selection['start'] is not None and event in (cv2.EVENT_MOUSEMOVE,
+                                                          cv2.EVENT_LBUTTONUP):
+            x0, y0 = selection['start']
+            if abs(x - x0) > 2 and abs(y - y0) > 2:
+                selection['box'] = (min(x, x0), min(y, y0), abs(x - x0), abs(y - y0))
+            if event == cv2.EVENT_LBUTTONUP:
+                selection['start'] = None
+    cv2.namedWindow('frame')
+    cv2.setMouseCallback('frame', onMouse)
+    return selection
+
+# Function to write the thresholds of one object into the camera_node color file
+def writeColorFile(path, objectName, color, threshold):
+    params = {}
+    if os.path.exists(path):
+        with open(path) as colorFile:
+            params = yaml.safe_load(colorFile) or {}
+    params[objectName + '_hsv_color'] = color
+    params[objectName + '_threshold'] = threshold
+    with open(path, 'w') as colorFile:
+        colorFile.write("# hsv colors and +- thresholds for camera_node, written by calibrateColor.py\n")
+        yaml.safe_dump(params, colorFile, default_flow_style=None)
+
+# Function to ask a running camera_node to switch to the new colors
+def reloadCameraNode(path):
+    try:
+        import rospy
+        from robotics_project.srv import reloadColors
+        rospy.wait_for_service('reloadColors', timeout=2)
+        print rospy.ServiceProxy('reloadColors', reloadColors)(os.path.abspath(path)).response
+    except Exception, e:
+        print "camera_node not reloaded (%s), it will read the file on its next start" % e
+
+# Function to collect histograms over the selected region and write thresholds
+def calibrateHistogram(cap, objectName, path, numFrames):
+    selection = selectRegion()
+    histogram = HsvHistogram()
+    collected = 0
+    collecting = False
+    print "Drag a box over the %s, then press c to collect %d frames" % (objectName, numFrames)
+    while collected < numFrames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        box = selection['box']
+        if collecting and box is not None:
+            x, y, w, h = box
+            hsvRegion = cv2.cvtColor(frame[y:y+h, x:x+w], cv2.COLOR_BGR2HSV)
+            histogram.add(hsvRegion)
+            collected += 1
+        if box is not None:
+            x, y, w, h = box
+            cv2.rectangle(frame, (x, y), (x+w, y+h), [0, 0, 255] if collecting else [255, 255, 255], 2)
+        cv2.imshow('frame', frame)
+        key = cv2.waitKey(10) & 0xFF
+        if key == ord('c') and box is not None:
+            collecting = True
+        elif key == ord('q'):
+            return
+    if collected == 0:
+        return
+    color, threshold = histogram.thresholds(coverage)
+    print "%s: hsv color %s, threshold %s" % (objectName, color, threshold)
+    writeColorFile(path, objectName, color, threshold)
+    print "Wrote", path
+    reloadCameraNode(path)
+    # show what the new thresholds pick up
+    lower = tuple(c - t for c, t in zip(color, threshold))
+    upper = tuple(c + t for c, t in zip(color, threshold))
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        mask = cv2.inRange(cv2.cvtColor(frame, cv2.COLOR_BGR2HSV), lower, upper)
+        frame[mask > 0] = [255, 255, 255]
+        cv2.imshow('frame', frame)
+        if cv2.waitKey(10) & 0xFF == ord('q'):
+            break
+
+# Function to pick the center color after a countdown and track it
+def trackCenterColor(cap):
+
+    # Find mid point
     ret, frame = cap.read()
+    mid = [frame.shape[0]/2, frame.shape[1]/2]
 
-	# Display the frame with the selected pixel blacked out
-    frame[mid[0]-3:mid[0]+3, mid[1]-3:mid[1]+3, :] = 0
-    cv2.imshow('frame', frame)
-    if cv2.waitKey(10) & 0xFF == ord('q'):
-        print "whoa whoa whoa..."
-
-	# every 100 frames give countdown
-    if i % 100 == 99:
-        print ((i//100) + 1)
-
-# Capture frame to get color from
-ret, frame = cap.read()
+    # Display frame with color to be selected blacked out
+    # so the user can see what's about to be selected
+    #while(True):
+    for i in range(300):
+        time.sleep(.01)
 
-#print "HERE!"
+        # Capture frame-by-frame
+        ret, frame = cap.read()
 
-# Get color in the center of the image
-colorWeWant = selectCenterColor(frame)
-print colorWeWant
+		# Display the frame with the selected pixel blacked out
+        frame[mid[0]-3:mid[0]+3, mid[1]-3:mid[1]+3, :] = 0
+        cv2.imshow('frame', frame)
+        if cv2.waitKey(10) & 0xFF == ord('q'):
+            print "whoa whoa whoa..."
 
-# Track the color in real time
-while(True):
-    time.sleep(.01)
+		# every 100 frames give countdown
+        if i % 100 == 99:
+            print ((i//100) + 1)
 
-    # Capture frame-by-frame
+    # Capture frame to get color from
     ret, frame = cap.read()
 
-    # Our operations on the frame come here
-    frame = processFrame(frame, colorWeWant)
-    #gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-    # Display the resulting frame
-    cv2.imshow('frame', frame)
-    if cv2.waitKey(10) & 0xFF == ord('q'):
-          break
-
-
-#interact(local=locals())
+    #print "HERE!"
 
+    # Get color in the center of the image
+    colorWeWant = selectCenterColor(frame)
+    print colorWeWant
 
+    # Track the color in real time
+    while(True):
+        time.sleep(.01)
 
+        # Capture frame-by-frame
+        ret, frame = cap.read()
 
+        # Our operations on the frame come here
+        frame = processFrame(frame, colorWeWant)
+        #gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
 
+        # Display the resulting frame
+        cv2.imshow('frame', frame)
+        if cv2.waitKey(10) & 0xFF == ord('q'):
+              break
 
-	
-################# Mess around to try to get color of ball
-"""
-# Capture frame-by-frame
-for i in range(100):
-	ret, frame = cap.read()
-
-# Our operations on the frame come here
-processedFrame = processFrame(frame)
-
-cv2.imshow('frame', processedFrame*255)
-if cv2.waitKey(10) & 0xFF == ord('q'):
-	print "something going on with the ord function"
 
-#print processedFrame[150:160, 320:330]
-#print processedFrame[50:60, 20:30]
+    #interact(local=locals())
 
-time.sleep(5)
-
-#print processedFrame[150:160, 320:330, 0]
-#print processedFrame[150:160, 320:330, 1]
-#print processedFrame[150:160, 320:330, 2]
-#test1 = processedFrame[150, 320, 0:3]
-#print test1.size
+    ################# Mess around to try to get color of ball
+    """
+    # Capture frame-by-frame
+    for i in range(100):
+		ret, frame = cap.read()
 
-#print processedFrame.shape
-#processedFrame[371:470, 541:640, 0:3] = processedFrame[1:100, 1:100, 0:3]
-#processedFrame[1:100, 1:100, 0:3] = 0
+    # Our operations on the frame come here
+    processedFrame = processFrame(frame)
 
-# Display the resulting frame
-#cv2.imshow('frame', processedFrame)
-#blackImage = np.zeros(processedFrame.shape)
-#print blackImage.shape
+    cv2.imshow('frame', processedFrame*255)
+    if cv2.waitKey(10) & 0xFF == ord('q'):
+		print "something going on with the ord function"
 
-"""
-##################
+    #print processedFrame[150:160, 320:330]
+    #print processedFrame[50:60, 20:30]
 
+    time.sleep(5)
 
+    #print processedFrame[150:160, 320:330, 0]
+    #print processedFrame[150:160, 320:330, 1]
+    #print processedFrame[150:160, 320:330, 2]
+    #test1 = processedFrame[150, 320, 0:3]
+    #print test1.size
 
-# When everything done, release the capture
-cap.release()
-cv2.destroyAllWindows()
+    #print processedFrame.shape
+    #processedFrame[371:470, 541:640, 0:3] = processedFrame[1:100, 1:100, 0:3]
+    #processedFrame[1:100, 1:100, 0:3] = 0
 
-	
+    # Display the resulting frame
+    #cv2.imshow('frame', processedFrame)
+    #blackImage = np.zeros(processedFrame.shape)
+    #print blackImage.shape
+
+    """
+    ##################
+
+
+if __name__ == "__main__":
+    cap = cv2.VideoCapture()
+    cap.open(0)
+    #cap.open('ball.avi')
+    if len(sys.argv) > 1:
+        path = sys.argv[2] if len(sys.argv) > 2 else default_color_file
+        numFrames = int(sys.argv[3]) if len(sys.argv) > 3 else 300
+        calibrateHistogram(cap, sys.argv[1], path, numFrames)
+    else:
+        trackCenterColor(cap)
+
+    # When everything done, release the capture
+    cap.release()
+    cv2.destroyAllWindows()
@@ -1,24 +1,41 @@
 #!/usr/bin/env python
 
 import rospy
+import rosparam
 import cv2
+import threading
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
 from robotics_project.srv import *
-from sensor_msgs.msg import Image
+from sensor_msgs.msg import Image, CompressedImage
+from std_msgs.msg import Header
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
 import numpy as np
 from cv_bridge import CvBridge, CvBridgeError
 import colorsys
 from code import interact
-from collections import deque
+from collections import deque, namedtuple
+from copy import copy
 from robotics_project.msg import objectPose
+from latency_trace import LatencyTracer
 
 drawBall = True
 drawGoal = True
+# the debug image is only drawn when someone subscribes to it, at most
+# debugImageRate times a second, downscaled by debugImageScale
+debugImageRate = 5.0
+debugImageScale = 0.5
+debugImageJpegQuality = 80
 
 ball_hsv_color = (0, 168, 138)
 ball_threshold = (8, 20, 20)
 #goal_hsv_color = (35, 98, 135) # Green?
 goal_hsv_color = (102, 210, 80)
 goal_threshold = (3, 8, 8)
+# the colors above are defaults, camera_node reads ~ball_hsv_color,
+# ~ball_threshold, ~goal_hsv_color and ~goal_threshold at startup (see
+# config/colors.yaml, written by calibrateColor.py) and again on reloadColors
 goal_num_frames_to_ave = 5
 num_frames_to_believe_its_lined_up = 20
 dist_to_consider_lined_up = 30
@@ -28,11 +45,408 @@ closeKernSizeForClose = 50
 closeKernSizeForFar = 30
 openKernSizeForGoal = 1
 closeKernSizeForGoal = 1
+# classify bgr8 frames with a precomputed lookup table instead of
+# converting every frame to hsv and thresholding it
+useColorLookupTable = True
+# only search a padded window around the last ball detection, growing it
+# with ball speed and missed frames and going back to the full frame once
+# the ball has been missing for trackingFramesBeforeFullSearch frames
+useBallTracking = True
+trackingPadding = openKernSizeForClose
+trackingSpeedGain = 2.0
+trackingMissGrowth = 40
+trackingFramesBeforeFullSearch = 5
+# find the ball on a copy of the mask downscaled by pyramidScale (with the
+# kernels scaled to match) and refine its box at full resolution in a
+# window padded by pyramidRefinePadding, see pyramid_tradeoff.py for the
+# accuracy each scale costs
+usePyramidDetection = True
+pyramidScale = 4
+pyramidRefinePadding = openKernSizeForClose
+# hand frames from the subscriber callback to a worker thread through a one
+# frame mailbox so only the newest frame is processed and stale ones dropped
+useLatestFrameOnly = True
+diagnosticsPeriod = 1.0
+# smooth the ball and goal with constant velocity kalman filters instead of
+# the frame averaging deques, noise is given per measured value
+useKalmanTracking = True
+ballMeasurementNoise = (3.0, 3.0, 2.0)      # center px, width px, distance in
+ballAccelerationNoise = (400.0, 100.0, 40.0)
+goalMeasurementNoise = (3.0, 3.0, 3.0, 3.0)  # left, right, top, bottom px
+goalAccelerationNoise = (200.0, 200.0, 100.0, 100.0)
+trackerMaxCoast = 1.0                        # seconds to predict without a measurement
+# step down through cheaper processing levels while the average frame takes
+# longer than processingBudget and back up once it drops below
+# budgetHeadroom of it, waiting budgetHoldFrames between steps. scale
+# downsamples the frame, kernelScale shrinks the ball kernels, goalEvery
+# only looks for the goal on every Nth frame
+useProcessingBudget = True
+processingBudget = 0.040
+budgetSmoothing = 0.1
+budgetHeadroom = 0.6
+budgetHoldFrames = 25
+qualityLevels = [
+    {'scale': 1, 'kernelScale': 1.0, 'goalEvery': 1, 'debugImage': True},
+    {'scale': 1, 'kernelScale': 1.0, 'goalEvery': 1, 'debugImage': False},
+    {'scale': 1, 'kernelScale': 1.0, 'goalEvery': 3, 'debugImage': False},
+    {'scale': 1, 'kernelScale': 0.6, 'goalEvery': 3, 'debugImage': False},
+    {'scale': 2, 'kernelScale': 0.6, 'goalEvery': 3, 'debugImage': False},
+    {'scale': 2, 'kernelScale': 0.6, 'goalEvery': 6, 'debugImage': False},
+]
+# wrap incoming image data as a numpy view instead of copying it through
+# CvBridge, and build outgoing images without CvBridge
+useZeroCopyImages = True
+# channels and cv2 conversion to bgr for the encodings we can wrap
+imageEncodings = {
+    'bgr8': (3, None),
+    'rgb8': (3, cv2.COLOR_RGB2BGR),
+    'bgra8': (4, cv2.COLOR_BGRA2BGR),
+    'rgba8': (4, cv2.COLOR_RGBA2BGR),
+    'mono8': (1, cv2.COLOR_GRAY2BGR),
+}
+# run the ball and goal detectors concurrently, OpenCV releases the GIL
+useParallelDetection = True
+detectionThreads = 4
 
-class CameraNode():
+# function to return binary image of color with tolerance threshold
+def threshold_image(hsv_image, color, threshold):
+    hsv_upper = (color[0]+threshold[0], color[1]+threshold[1], color[2]+threshold[2])
+    hsv_lower = (color[0]-threshold[0], color[1]-threshold[1], color[2]-threshold[2])
+    binary_image = cv2.inRange(hsv_image, hsv_lower, hsv_upper)
+    return binary_image
+
+# function to return the pixels of a ROS image as a numpy view of its data,
+# rows are step bytes apart so padded images are wrapped without a copy
+def wrap_image_msg(raw_ros_image):
+    channels = imageEncodings[raw_ros_image.encoding][0]
+    if channels == 1:
+        shape, strides = (raw_ros_image.height, raw_ros_image.width), (raw_ros_image.step, 1)
+    else:
+        shape = (raw_ros_image.height, raw_ros_image.width, channels)
+        strides = (raw_ros_image.step, channels, 1)
+    return np.ndarray(shape=shape, dtype=np.uint8, buffer=raw_ros_image.data,
+                      strides=strides)
+
+# function to build a bgr8 ROS image from a cv2 image, the only copy made is
+# the byte string the message serializer needs
+def bgr_to_image_msg(bgr_image, stamp):
+    ros_image = Image()
+    ros_image.header.stamp = stamp
+    ros_image.height, ros_image.width = bgr_image.shape[:2]
+    ros_image.encoding = "bgr8"
+    ros_image.is_bigendian = 0
+    ros_image.step = ros_image.width * 3
+    ros_image.data = np.ascontiguousarray(bgr_image).tostring()
+    return ros_image
+
+Blob = namedtuple('Blob', ['area', 'x', 'y', 'w', 'h', 'cx', 'cy'])
+
+# function to label a binary image in one pass and return a Blob (pixel area,
+# bounding box and centroid) for every connected region in it
+def find_blobs(frame):
+    if hasattr(cv2, 'connectedComponentsWithStats'):
+        count, labels, stats, centroids = cv2.connectedComponentsWithStats(frame, connectivity=8)
+        return [Blob(stat[4], stat[0], stat[1], stat[2], stat[3], centroid[0], centroid[1])
+                for stat, centroid in zip(stats[1:].tolist(), centroids[1:].tolist())]
+    # OpenCV 2.4 has no connected components, use outer contours instead
+    # (findContours writes into the image it is given, hence the copy)
+    contours = cv2.findContours(frame.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0]
+    blobs = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        moments = cv2.moments(contour)
+        if moments['m00'] > 0:
+            blobs.append(Blob(moments['m00'], x, y, w, h,
+                              moments['m10']/moments['m00'], moments['m01']/moments['m00']))
+        else:
+            blobs.append(Blob(w*h, x, y, w, h, x + w/2.0, y + h/2.0))
+    return blobs
+
+# function to pick the blob with the highest score, largest area by default
+def select_blob(blobs, score=None):
+    if not blobs:
+        return None
+    if score is None:
+        return max(blobs, key=lambda blob: blob.area)
+    return max(blobs, key=score)
+
+# function to close and open a binary image and find an object in it
+def find_object_in_mask(frame, closeKernSize, openKernSize, score=None):
+    # close and open to get rid of noise and unify object
+    kernel = np.ones((closeKernSize,closeKernSize),np.uint8)
+    frame = cv2.morphologyEx(frame, cv2.MORPH_CLOSE, kernel)
+    kernel = np.ones((openKernSize,openKernSize),np.uint8)
+    frame = cv2.morphologyEx(frame, cv2.MORPH_OPEN, kernel)
+    blob = select_blob(find_blobs(frame), score)
+    if blob is not None:
+            return [blob.x, blob.y, blob.w, blob.h, frame]
+    else:
+            return [-1, -1, -1, -1, -1]
+
+# function to find an object inside the (x, y, w, h) region of a binary image,
+# the returned box is in full image coordinates
+def find_object_in_region(frame, region, closeKernSize, openKernSize):
+    x, y, w, h = region
+    result = find_object_in_mask(frame[y:y+h, x:x+w], closeKernSize, openKernSize)
+    if result[0] != -1:
+        result[0] += x
+        result[1] += y
+    return result
+
+# function to find an object on a downscaled copy of a binary image and then
+# refine its box at full resolution in a padded window around the coarse box
+def find_object_pyramid(frame, closeKernSize, openKernSize, scale, padding):
+    rows, cols = frame.shape[:2]
+    small = cv2.resize(frame, (cols // scale, rows // scale),
+                       interpolation=cv2.INTER_AREA)
+    small = cv2.threshold(small, 127, 255, cv2.THRESH_BINARY)[1]
+    x, y, w, h, _ = find_object_in_mask(small, max(1, closeKernSize // scale),
+                                        max(1, openKernSize // scale))
+    if x == -1:
+        return [-1, -1, -1, -1, -1]
+    left = max(0, x*scale - padding)
+    top = max(0, y*scale - padding)
+    right = min(cols, (x + w)*scale + padding)
+    bottom = min(rows, (y + h)*scale + padding)
+    return find_object_in_region(frame, (left, top, right - left, bottom - top),
+                                 closeKernSize, openKernSize)
+
+# function to calculate distance from width for the ball
+def calc_ball_dist(bw):
+    if bw > 0:
+        return (4997 * (bw**(-0.95)))
+    else:
+        return -1
+
+# the last lookup table built and its colors, building one takes seconds so
+# CameraNodes made with the same colors share it (soccer_simulator.py makes
+# one per episode)
+lastColorTable = (None, None)
+
+class ColorLookupTable():
+    """Classify bgr8 pixels into binary masks with one table lookup
+
+    Every one of the 2^24 bgr colors is run through the same cvtColor and
+    inRange calls as the hsv path when the table is built, so the masks
+    returned by classify are identical to thresholding the hsv image.
+    """
+    chunk_shape = (1024, 4096)
+
+    def __init__(self, color_ranges):
+        """Build the table, color_ranges is a list of (hsv color, threshold)"""
+        self.num_masks = len(color_ranges)
+        self.table = np.empty((1 << 24, self.num_masks), np.uint8)
+        self.packed = None
+        chunk_size = self.chunk_shape[0] * self.chunk_shape[1]
+        for start in range(0, 1 << 24, chunk_size):
+            # color codes are little endian b | g << 8 | r << 16, the same
+            # layout classify reads out of its padded frame buffer
+            codes = np.arange(start, start + chunk_size, dtype='<u4')
+            bgr = codes.view(np.uint8).reshape(self.chunk_shape + (4,))[:, :, :3]
+            hsv = cv2.cvtColor(np.ascontiguousarray(bgr), cv2.COLOR_BGR2HSV)
+            for index, (color, threshold) in enumerate(color_ranges):
+                mask = threshold_image(hsv, color, threshold)
+                self.table[start:start + chunk_size, index] = mask.ravel()
+
+    def classify(self, bgr_image):
+        """Return one binary mask per color range for a bgr8 image"""
+        rows, cols = bgr_image.shape[:2]
+        if self.packed is None or self.packed.shape[:2] != (rows, cols):
+            self.packed = np.zeros((rows, cols, 4), np.uint8)
+        self.packed[:, :, :3] = bgr_image
+        codes = self.packed.view('<u4').reshape(rows, cols)
+        masks = self.table.take(codes, axis=0)
+        return cv2.split(masks)
+
+class SearchWindow():
+    """Padded region around the last detection of a tracked object"""
+    def __init__(self, padding, speed_gain, miss_growth, max_misses):
+        self.padding = padding
+        self.speed_gain = speed_gain
+        self.miss_growth = miss_growth
+        self.max_misses = max_misses
+        self.rect = None
+        self.velocity = (0, 0)
+        self.misses = 0
+        self.clipped = False
+
+    def region(self, shape):
+        """Return the (x, y, w, h) to search, None means search the whole frame"""
+        if self.rect is None:
+            return None
+        rows, cols = shape[:2]
+        x, y, w, h = self.rect
+        vx, vy = self.velocity
+        # the object keeps moving while we miss it, and a box cut off by
+        # the window edge means we don't really know how big it is
+        steps = self.misses + 1
+        pad = self.padding + self.miss_growth * self.misses
+        if self.clipped:
+            pad += self.miss_growth
+        pad_x = pad + self.speed_gain * abs(vx) * steps
+        pad_y = pad + self.speed_gain * abs(vy) * steps
+        left = max(0, int(x + vx * steps - pad_x))
+        top = max(0, int(y + vy * steps - pad_y))
+        right = min(cols, int(x + w + vx * steps + pad_x))
+        bottom = min(rows, int(y + h + vy * steps + pad_y))
+        if right <= left or bottom <= top:
+            return None
+        return left, top, right - left, bottom - top
+
+    def update(self, rect, region, shape):
+        """Record this frame's detection, rect is None if nothing was found"""
+        if rect is None:
+            self.misses += 1
+            if self.misses >= self.max_misses:
+                self.rect = None
+                self.velocity = (0, 0)
+                self.misses = 0
+            return
+        if self.rect is not None and self.misses == 0:
+            self.velocity = ((rect[0] + rect[2]/2.0) - (self.rect[0] + self.rect[2]/2.0),
+                             (rect[1] + rect[3]/2.0) - (self.rect[1] + self.rect[3]/2.0))
+        else:
+            self.velocity = (0, 0)
+        self.clipped = False
+        if region is not None:
+            rows, cols = shape[:2]
+            x, y, w, h = rect
+            rx, ry, rw, rh = region
+            self.clipped = ((x <= rx and rx > 0) or (y <= ry and ry > 0) or
+                            (x + w >= rx + rw and rx + rw < cols) or
+                            (y + h >= ry + rh and ry + rh < rows))
+        self.rect = rect
+        self.misses = 0
+
+class KalmanTracker():
+    """Constant velocity kalman filter over a set of measured values
+
+    The state is the measured values followed by their velocities.
+    """
+    def __init__(self, measurement_noise, acceleration_noise, max_coast):
+        self.size = len(measurement_noise)
+        self.R = np.diag(np.square(measurement_noise))
+        self.accel_var = np.diag(np.square(acceleration_noise))
+        self.H = np.hstack([np.eye(self.size), np.zeros((self.size, self.size))])
+        self.max_coast = max_coast
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.x = None
+        self.P = None
+        self.stamp = None
+        self.last_measured = None
+
+    def _predict(self, stamp):
+        dt = stamp - self.stamp
+        F = np.eye(2 * self.size)
+        F[:self.size, self.size:] = dt * np.eye(self.size)
+        # white noise acceleration between updates
+        G = np.array([[dt**4 / 4, abs(dt)**3 / 2], [abs(dt)**3 / 2, dt**2]])
+        Q = np.kron(G, self.accel_var)
+        return F.dot(self.x), F.dot(self.P).dot(F.T) + Q
+
+    def update(self, measurement, stamp):
+        """Correct the filter with a measurement taken at stamp (seconds)"""
+        z = np.asarray(measurement, dtype=np.float64)
+        with self.lock:
+            if self.x is not None and stamp - self.last_measured > self.max_coast:
+                # the old track went stale, start a new one from this measurement
+                self.reset()
+            if self.x is None:
+                self.x = np.hstack([z, np.zeros(self.size)])
+                self.P = np.diag(np.hstack([np.diag(self.R), 100 * np.diag(self.accel_var)]))
+            else:
+                x, P = self._predict(stamp)
+                S = self.H.dot(P).dot(self.H.T) + self.R
+                K = P.dot(self.H.T).dot(np.linalg.inv(S))
+                self.x = x + K.dot(z - self.H.dot(x))
+                self.P = (np.eye(2 * self.size) - K.dot(self.H)).dot(P)
+            self.stamp = stamp
+            self.last_measured = stamp
+
+    def estimate(self, stamp):
+        """Return (state, covariance) predicted at stamp, None if there is no
+        track or it hasn't been measured for max_coast seconds"""
+        with self.lock:
+            if self.x is None:
+                return None
+            if stamp - self.last_measured > self.max_coast:
+                return None
+            return self._predict(stamp)
+
+class ProcessingBudget():
+    """Picks the quality level from a running average of the frame processing time"""
+    def __init__(self, budget, levels, smoothing, headroom, hold_frames):
+        self.budget = budget
+        self.levels = levels
+        self.smoothing = smoothing
+        self.headroom = headroom
+        self.hold_frames = hold_frames
+        self.index = 0
+        self.average = None
+        self.frames_at_level = 0
+
+    def level(self):
+        return self.levels[self.index]
+
+    def record(self, seconds):
+        """Add the processing time of a frame, possibly changing the level"""
+        if self.average is None:
+            self.average = seconds
+        else:
+            self.average += self.smoothing * (seconds - self.average)
+        self.frames_at_level += 1
+        if self.frames_at_level < self.hold_frames:
+            return
+        if self.average > self.budget and self.index < len(self.levels) - 1:
+            self.index += 1
+        elif self.average < self.headroom * self.budget and self.index > 0:
+            self.index -= 1
+        else:
+            return
+        # the old average says nothing about the new level
+        self.average = None
+        self.frames_at_level = 0
+
+class FrameMailbox():
+    """Single slot holding the newest frame, an unprocessed frame is dropped
+    when a newer one arrives"""
     def __init__(self):
-        """Start camera_node and setup publishers/subscribers"""
-        self.numPixelsToBelieveGoalIsInView = 10000
+        self.condition = threading.Condition()
+        self.frame = None
+        self.arrival = 0
+        self.received = 0
+        self.dropped = 0
+
+    def put(self, frame):
+        """Replace the frame in the mailbox and wake up the worker"""
+        with self.condition:
+            if self.frame is not None:
+                self.dropped += 1
+            self.frame = frame
+            self.arrival = time.time()
+            self.received += 1
+            self.condition.notify()
+
+    def take(self, timeout):
+        """Return (frame, seconds it waited in the mailbox), frame is None on timeout"""
+        with self.condition:
+            if self.frame is None:
+                self.condition.wait(timeout)
+            if self.frame is None:
+                return None, 0
+            frame = self.frame
+            self.frame = None
+            return frame, time.time() - self.arrival
+
+class CameraNode():
+    def __init__(self, start_node=True):
+        """Start camera_node and setup publishers/subscribers, with start_node
+        False only the processing state is set up so the pipeline can run offline"""
+        # pixel count, the same as the old check of the 0/255 mask sum against 10000
+        self.numPixelsToBelieveGoalIsInView = 40
         self.bridge = CvBridge()
         self.testing = False
         self.ballWidthList = deque([0]*10)
@@ -48,97 +462,270 @@ class CameraNode():
         self.goalBot = 0
         self.goalTop = 0
         self.goalWidth = 0
+        self.colorTable = None
+        self.colors = None
+        self.ballWindow = None
+        if useBallTracking:
+            self.ballWindow = SearchWindow(trackingPadding, trackingSpeedGain,
+                                           trackingMissGrowth,
+                                           trackingFramesBeforeFullSearch)
+        self.ballTracker = None
+        self.goalTracker = None
+        if useKalmanTracking:
+            self.ballTracker = KalmanTracker(ballMeasurementNoise, ballAccelerationNoise,
+                                             trackerMaxCoast)
+            self.goalTracker = KalmanTracker(goalMeasurementNoise, goalAccelerationNoise,
+                                             trackerMaxCoast)
+        self.lastPose = objectPose()
+        self.budget = None
+        if useProcessingBudget:
+            self.budget = ProcessingBudget(processingBudget, qualityLevels, budgetSmoothing,
+                                           budgetHeadroom, budgetHoldFrames)
+        self.lastGoal = None
+        self.framesSinceGoal = 0
+        self.processingTime = 0
+        self.detectorPool = None
+        if useParallelDetection:
+            self.detectorPool = ThreadPool(detectionThreads)
+        self.frameMailbox = None
+        if useLatestFrameOnly:
+            self.frameMailbox = FrameMailbox()
+        self.framesProcessed = 0
+        self.queueAge = 0
+        self.maxQueueAge = 0
+        self.frameAge = 0
+        self.lastDebugImageTime = 0
+        self.latency = None
+        if not start_node:
+            self._set_colors(ball_hsv_color, ball_threshold, goal_hsv_color, goal_threshold)
+            self.objectPosePub = None
+            return
         self.objectPosePub = rospy.Publisher("/camera_node/objectPose", 
                                             objectPose, queue_size = 10)
         self.image_pub = rospy.Publisher("/camera_node/processed_image",
                                          Image,
                                          queue_size = 10)
+        self.compressed_image_pub = rospy.Publisher("/camera_node/processed_image/compressed",
+                                                    CompressedImage,
+                                                    queue_size = 1)
+        self.diagnostics_pub = rospy.Publisher("/diagnostics", DiagnosticArray,
+                                               queue_size = 1)
         rospy.init_node('camera_node')
+        self.latency = LatencyTracer('camera_node', ['objectPose published'])
+        self._load_colors()
+        self.reload_service = rospy.Service('reloadColors', reloadColors,
+                                            self.handle_reloadColors)
+        self.predict_service = rospy.Service('predictPose', predictPose,
+                                             self.handle_predictPose)
+        # a small queue and a buffer bigger than a frame keep rospy from
+        # piling up old images behind a slow callback
         self.camera_subscriber = rospy.Subscriber(
                 "/camera/visible/image",
                 Image,
-                self._handle_incoming_image
+                self._handle_incoming_image,
+                queue_size = 1,
+                buff_size = 2**24
         )
+        if self.frameMailbox is not None:
+            self.worker = threading.Thread(target=self._process_frames)
+            self.worker.daemon = True
+            self.worker.start()
+        self.diagnostics_timer = rospy.Timer(rospy.Duration(diagnosticsPeriod),
+                                             self._publish_diagnostics)
         rospy.spin()
 
-    def _convert_raw_2_hsv(self, raw_ros_image):
-        """Convert a ROS image message into cv2 bgr8 format"""
+    def _convert_raw_2_bgr(self, raw_ros_image):
+        """Convert a ROS image message into cv2 bgr8 format, bgr8 images are not copied"""
+        if useZeroCopyImages and raw_ros_image.encoding in imageEncodings:
+            try:
+                image = wrap_image_msg(raw_ros_image)
+            except TypeError:
+                # data is a list or shorter than step * height
+                pass
+            else:
+                conversion = imageEncodings[raw_ros_image.encoding][1]
+                if conversion is None:
+                    return image
+                return cv2.cvtColor(image, conversion)
         cv_image = self.bridge.imgmsg_to_cv2(raw_ros_image, "bgr8")
-        hsv_image = cv2.cvtColor(cv_image, cv2.COLOR_BGR2HSV) 
-        return hsv_image
+        return cv_image
+
+    # function to read the colors from the parameter server, the module
+    # level colors are used for any that aren't set
+    def _load_colors(self):
+        self._set_colors(rospy.get_param('~ball_hsv_color', ball_hsv_color),
+                         rospy.get_param('~ball_threshold', ball_threshold),
+                         rospy.get_param('~goal_hsv_color', goal_hsv_color),
+                         rospy.get_param('~goal_threshold', goal_threshold))
+
+    # function to switch to new colors, the new lookup table is built before
+    # it replaces the old one so frames keep being processed meanwhile
+    def _set_colors(self, ballColor, ballThreshold, goalColor, goalThreshold):
+        global lastColorTable
+        colors = (tuple(ballColor), tuple(ballThreshold), tuple(goalColor), tuple(goalThreshold))
+        colorTable = None
+        if useColorLookupTable:
+            lastColors, colorTable = lastColorTable
+            if lastColors != colors:
+                colorTable = ColorLookupTable([(colors[0], colors[1]), (colors[2], colors[3])])
+                lastColorTable = (colors, colorTable)
+        self.colors = colors
+        self.colorTable = colorTable
+
+    def handle_reloadColors(self, request):
+        """Load request.path (or ~color_file) onto the parameter server and switch to its colors"""
+        path = request.path or rospy.get_param('~color_file', '')
+        if path:
+            try:
+                for params, namespace in rosparam.load_file(path, rospy.get_name() + '/'):
+                    rosparam.upload_params(namespace, params)
+            except Exception, e:
+                return "Could not load %s: %s" % (path, e)
+        self._load_colors()
+        return "Colors reloaded: ball %s +- %s, goal %s +- %s" % self.colors
+
+    # function to return the ball and goal binary images of a bgr frame
+    def _segment_image(self, bgr_image):
+        colorTable = self.colorTable
+        if colorTable is not None:
+            ball_mask, goal_mask = colorTable.classify(bgr_image)
+            return ball_mask, goal_mask
+        ballColor, ballThreshold, goalColor, goalThreshold = self.colors
+        hsv_image = cv2.cvtColor(bgr_image, cv2.COLOR_BGR2HSV)
+        ball_mask = self._threshold_image(hsv_image, ballColor, ballThreshold)
+        goal_mask = self._threshold_image(hsv_image, goalColor, goalThreshold)
+        return ball_mask, goal_mask
 
     # function to find an object of the specified color and threshold
     # frame must be in hsv
     def findObject(self, frame, color, threshold, closeKernSize, openKernSize):
         frame = self._threshold_image(frame, color, threshold)
-        # close and open to get rid of noise and unify object
-        kernel = np.ones((closeKernSize,closeKernSize),np.uint8)
-        frame = cv2.morphologyEx(frame, cv2.MORPH_CLOSE, kernel)
-        kernel = np.ones((openKernSize,openKernSize),np.uint8)
-        frame = cv2.morphologyEx(frame, cv2.MORPH_OPEN, kernel)
-        # find contours
-        contour_struct = cv2.findContours(frame, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
-        contours = contour_struct[0]
-        if len(contours)>0:
-                x, y, w, h = cv2.boundingRect(contours[0])  # <<----  This assumes there is only 1 contour
-                return [x, y, w, h, frame]
+        return self.findObjectInMask(frame, closeKernSize, openKernSize)
+
+    # function to find an object in an already thresholded binary image
+    def findObjectInMask(self, frame, closeKernSize, openKernSize):
+        return find_object_in_mask(frame, closeKernSize, openKernSize)
+
+    # function to find the ball, only searching near its last position while tracking
+    # the mask may be downsampled by scale, the box returned is in full frame pixels
+    def findBall(self, mask, scale=1, kernelScale=1.0):
+        closeKernSize = max(1, int(openKernSizeForClose * kernelScale / scale))
+        openKernSize = max(1, int(closeKernSizeForFar * kernelScale / scale))
+        shape = (mask.shape[0] * scale, mask.shape[1] * scale)
+        region = None
+        if self.ballWindow is not None:
+            region = self.ballWindow.region(shape)
+        if region is not None:
+            result = find_object_in_region(mask, [value // scale for value in region],
+                                           closeKernSize, openKernSize)
+        elif usePyramidDetection and pyramidScale // scale > 1:
+            result = find_object_pyramid(mask, closeKernSize, openKernSize,
+                                         pyramidScale // scale,
+                                         pyramidRefinePadding // scale)
         else:
-                return [-1, -1, -1, -1, -1]
+            result = self.findObjectInMask(mask, closeKernSize, openKernSize)
+        if result[0] != -1 and scale != 1:
+            result[:4] = [value * scale for value in result[:4]]
+        if self.ballWindow is not None:
+            if result[0] != -1:
+                self.ballWindow.update(tuple(result[:4]), region, shape)
+            else:
+                self.ballWindow.update(None, region, shape)
+        return result
 
     # special function to find the goal specifically
     def findGoal(self, frame, color, threshold, closeKernSize, openKernSize):
         frame = self._threshold_image(frame, color, threshold)
-        numPixelsOfCorrectColor = frame.sum()
-        nonzeroRows, nonzeroCols = np.nonzero(frame)
+        return self.findGoalInMask(frame)
+
+    # function to find the goal in an already thresholded binary image
+    # (the mask may be downsampled by scale, the box returned is in full frame pixels)
+    def findGoalInMask(self, frame, scale=1):
+        numPixelsOfCorrectColor = cv2.countNonZero(frame) * scale * scale
         if numPixelsOfCorrectColor < self.numPixelsToBelieveGoalIsInView:
             return [-1, -1, -1, -1, frame]
+        # project the mask onto its rows and columns to get the goal extent
+        nonzeroRows = np.flatnonzero(frame.max(axis=1))
+        nonzeroCols = np.flatnonzero(frame.max(axis=0))
         if len(nonzeroRows) !=0:
-            top = min(nonzeroRows)
-            bot = max(nonzeroRows)
-            left = min(nonzeroCols)
-            right = max(nonzeroCols)
-            return [left, top, right-left, bot-top, frame]
+            top = nonzeroRows[0]
+            bot = nonzeroRows[-1]
+            left = nonzeroCols[0]
+            right = nonzeroCols[-1]
+            return [left*scale, top*scale, (right-left)*scale, (bot-top)*scale, frame]
         return [-1, -1, -1, -1, frame]
 
     # function to return binary image of color with tolerance threshold
     def _threshold_image(self, hsv_image, color, threshold):
-        hsv_upper = (color[0]+threshold[0], color[1]+threshold[1], color[2]+threshold[2])
-        hsv_lower = (color[0]-threshold[0], color[1]-threshold[1], color[2]-threshold[2])
-        binary_image = cv2.inRange(hsv_image, hsv_lower, hsv_upper)
-        return binary_image
+        return threshold_image(hsv_image, color, threshold)
 
     # function to calculate distance from width for the ball
     def _calcBallDist(self, bw):
-        if bw > 0:
-            return (4997 * (bw**(-0.95)))
-        else:
-            return -1
+        return calc_ball_dist(bw)
 
     # function to calculate distance from width for the goal ############# <--- Still needs to be done!!!!
     def _calcGoalDist(self, gw):
-        if gw!=-1:
+        # the tracker's predicted width can shrink to nothing while the goal coasts
+        if gw > 0:
             return (17263 * (gw**(-0.96)))
         else:
             return -1
         
+    # function to run independent detectors given as (function, args) pairs,
+    # concurrently on the detector pool if there is one, results come back in order
+    def _run_detectors(self, jobs):
+        if self.detectorPool is None:
+            return [function(*args) for function, args in jobs]
+        pending = [self.detectorPool.apply_async(function, args) for function, args in jobs]
+        return [result.get() for result in pending]
+
     # function to find ball and goal and transmit the objectPose message to topic objectPose 
-    def _process_image(self, hsv_image):
-        # find ball
-        bx, by, bw, bh, bMask = self.findObject(hsv_image, ball_hsv_color, ball_threshold, 
-                                         openKernSizeForClose, closeKernSizeForFar)
+    def _process_image(self, bgr_image, stamp):
+        level = qualityLevels[0]
+        if self.budget is not None:
+            level = self.budget.level()
+        scale = level['scale']
+        if scale != 1:
+            # nearest keeps the exact pixel colors the lookup table expects
+            rows, cols = bgr_image.shape[:2]
+            bgr_image = cv2.resize(bgr_image, (cols // scale, rows // scale),
+                                   interpolation=cv2.INTER_NEAREST)
+        ball_mask, goal_mask = self._segment_image(bgr_image)
+        # find ball and goal, the goal only every goalEvery frames
+        jobs = [(self.findBall, (ball_mask, scale, level['kernelScale']))]
+        self.framesSinceGoal += 1
+        findGoal = self.lastGoal is None or self.framesSinceGoal >= level['goalEvery']
+        if findGoal:
+            jobs.append((self.findGoalInMask, (goal_mask, scale)))
+            self.framesSinceGoal = 0
+        results = self._run_detectors(jobs)
+        ball = results[0]
+        if findGoal:
+            self.lastGoal = results[1]
+        objectPoseMessage, rects = self._build_pose(ball, self.lastGoal, stamp, findGoal)
+        # publish objectPose message
+        if self.objectPosePub is not None:
+            self.objectPosePub.publish(objectPoseMessage)
+            self.latency.record_since('objectPose published', stamp)
+        return rects
+
+    # function to update the smoothed estimates with this frame's detections and
+    # build the objectPose message, returns it with the rectangles to draw
+    # (goalFresh is False when the goal wasn't looked for and goal is the last detection)
+    def _build_pose(self, ball, goal, stamp, goalFresh=True):
+        bx, by, bw, bh, bMask = ball
         self.ballWidthList.append(bw)
         self.ballWidthList.popleft()
         self.ballWidth = round(sum(self.ballWidthList)/10.0)
-        # find goal
-        gx, gy, gw, gh, gMask = self.findGoal(hsv_image, goal_hsv_color, goal_threshold, 
-                                         openKernSizeForGoal, closeKernSizeForGoal)
+        gx, gy, gw, gh, gMask = goal
         #gx, gy, gw, gh, gMask = self.findObject(hsv_image, goal_hsv_color, goal_threshold, 
         #                                 openKernSizeForGoal, closeKernSizeForGoal)
         # update goal estimates
-        self.goalWidthList.append(gw)
-        self.goalWidthList.popleft()
-        self.goalWidth = round(sum(self.goalWidthList)/10.0)
-        if gx!=-1:
+        if goalFresh:
+            self.goalWidthList.append(gw)
+            self.goalWidthList.popleft()
+            self.goalWidth = round(sum(self.goalWidthList)/10.0)
+        if gx!=-1 and goalFresh:
             self.goalTopList.append(gy)
             self.goalTopList.popleft()
             self.goalTop = max(self.goalTopList)
@@ -151,17 +738,32 @@ class CameraNode():
             self.goalRightList.append(gx+gw)
             self.goalRightList.popleft()
             self.goalRight = min(self.goalRightList)
-        b_center_x = round(bx + (bw/2))
-        g_center_x = round((self.goalLeft+self.goalRight)/2)
-        distFromBallToGoal = abs(b_center_x - g_center_x)
         # create and populate objectPose message
         objectPoseMessage = objectPose() 
-        objectPoseMessage.ball_center_x = b_center_x
+        objectPoseMessage.header.stamp = stamp
+        objectPoseMessage.ball_center_x = round(bx + (bw/2))
         objectPoseMessage.ball_width = self.ballWidth
         objectPoseMessage.ball_distance = self._calcBallDist(self.ballWidth)
-        objectPoseMessage.goal_center_x = g_center_x
+        objectPoseMessage.goal_center_x = round((self.goalLeft+self.goalRight)/2)
         objectPoseMessage.goal_width = self.goalRight - self.goalLeft
         objectPoseMessage.goal_distance = self._calcGoalDist(gw)
+        # the trackers' estimates replace the averages above
+        if self.ballTracker is not None:
+            if bx != -1:
+                self.ballTracker.update([bx + bw/2.0, bw, self._calcBallDist(bw)],
+                                        stamp.to_sec())
+            if gx != -1 and goalFresh:
+                self.goalTracker.update([gx, gx+gw, gy, gy+gh], stamp.to_sec())
+            ballEstimate, goalEstimate = self._fill_tracked_pose(objectPoseMessage,
+                                                                 stamp.to_sec())
+            if ballEstimate is not None:
+                self.ballWidth = objectPoseMessage.ball_width
+            if goalEstimate is not None:
+                self.goalLeft, self.goalRight, self.goalTop, self.goalBot = [
+                        int(round(value)) for value in goalEstimate[0][:4]]
+        b_center_x = objectPoseMessage.ball_center_x
+        g_center_x = objectPoseMessage.goal_center_x
+        distFromBallToGoal = abs(b_center_x - g_center_x)
         if distFromBallToGoal < num_frames_to_believe_its_lined_up and bx!=-1 and gx!=-1:
             objectPoseMessage.ball_goal_lined_up_maybe = 1
             self.ballAndGoalLinedUpList.append(1)
@@ -178,17 +780,83 @@ class CameraNode():
             objectPoseMessage.goal_in_view = 1
         else:
             objectPoseMessage.goal_in_view = 0
-        # publish objectPose message
-        self.objectPosePub.publish(objectPoseMessage)
-        # draw ball rectangle on image
-        if drawBall:            
-            bPoint1, bPoint2 = (bx, by), (bx+bw, by+bh)
-            cv2.rectangle(hsv_image, bPoint1, bPoint2, [255, 255, 255], 2)
-        # draw goal rectangle on image
+        self.lastPose = objectPoseMessage
+        # rectangles for the debug image
+        rects = []
+        if drawBall and bx != -1:
+            rects.append(((bx, by), (bx+bw, by+bh)))
         if drawGoal and gx != -1:
-            gPoint1, gPoint2 = (self.goalLeft, self.goalTop), (self.goalRight, self.goalBot)
-            cv2.rectangle(hsv_image, gPoint1, gPoint2, [255, 255, 255], 2)
-        return hsv_image
+            rects.append(((self.goalLeft, self.goalTop), (self.goalRight, self.goalBot)))
+        return objectPoseMessage, rects
+
+    # function to fill the ball and goal fields of an objectPose message with
+    # the trackers' estimates at time t (seconds), returns the estimates
+    def _fill_tracked_pose(self, objectPoseMessage, t):
+        ballEstimate = self.ballTracker.estimate(t)
+        if ballEstimate is not None:
+            state, covariance = ballEstimate
+            objectPoseMessage.ball_center_x = round(state[0])
+            objectPoseMessage.ball_width = int(round(state[1]))
+            objectPoseMessage.ball_distance = state[2]
+            objectPoseMessage.ball_center_x_velocity = state[3]
+            objectPoseMessage.ball_width_velocity = state[4]
+            objectPoseMessage.ball_distance_velocity = state[5]
+            objectPoseMessage.ball_covariance = covariance.ravel().tolist()
+        goalEstimate = self.goalTracker.estimate(t)
+        if goalEstimate is not None:
+            state, covariance = goalEstimate
+            goalWidth = int(round(state[1] - state[0]))
+            objectPoseMessage.goal_center_x = round((state[0] + state[1]) / 2)
+            objectPoseMessage.goal_width = goalWidth
+            objectPoseMessage.goal_distance = self._calcGoalDist(goalWidth)
+            objectPoseMessage.goal_center_x_velocity = (state[4] + state[5]) / 2
+            objectPoseMessage.goal_width_velocity = state[5] - state[4]
+            objectPoseMessage.goal_covariance = covariance.ravel().tolist()
+        return ballEstimate, goalEstimate
+
+    def handle_predictPose(self, request):
+        """Return the last objectPose with the trackers' state predicted at request.stamp"""
+        objectPoseMessage = copy(self.lastPose)
+        objectPoseMessage.header = Header(stamp=request.stamp)
+        if self.ballTracker is not None:
+            self._fill_tracked_pose(objectPoseMessage, request.stamp.to_sec())
+        return objectPoseMessage
+
+    # function to draw the detections on the bgr frame and publish it, only
+    # when someone is listening and no more often than debugImageRate
+    def _publish_debug_image(self, bgr_image, rects, stamp):
+        raw_wanted = self.image_pub.get_num_connections() > 0
+        compressed_wanted = self.compressed_image_pub.get_num_connections() > 0
+        if not (raw_wanted or compressed_wanted):
+            return
+        now = time.time()
+        if now - self.lastDebugImageTime < 1.0 / debugImageRate:
+            return
+        self.lastDebugImageTime = now
+        if debugImageScale != 1:
+            bgr_image = cv2.resize(bgr_image, None, fx=debugImageScale, fy=debugImageScale,
+                                   interpolation=cv2.INTER_NEAREST)
+        else:
+            # the frame may be a read-only view of the incoming message
+            bgr_image = bgr_image.copy()
+        for point1, point2 in rects:
+            point1 = (int(point1[0]*debugImageScale), int(point1[1]*debugImageScale))
+            point2 = (int(point2[0]*debugImageScale), int(point2[1]*debugImageScale))
+            cv2.rectangle(bgr_image, point1, point2, [255, 255, 255], 2)
+        if raw_wanted:
+            if useZeroCopyImages:
+                ros_image = bgr_to_image_msg(bgr_image, stamp)
+            else:
+                ros_image = self.bridge.cv2_to_imgmsg(bgr_image, "bgr8")
+                ros_image.header.stamp = stamp
+            self.image_pub.publish(ros_image)
+        if compressed_wanted:
+            compressed_image = CompressedImage()
+            compressed_image.header.stamp = stamp
+            compressed_image.format = "jpeg"
+            compressed_image.data = cv2.imencode('.jpg', bgr_image,
+                    [cv2.IMWRITE_JPEG_QUALITY, debugImageJpegQuality])[1].tostring()
+            self.compressed_image_pub.publish(compressed_image)
 
     def _find_center(self, mask):
         contours, heirarchy = cv2.findContours(mask,
@@ -212,25 +880,81 @@ class CameraNode():
         return velocity, rotation
 
     def _handle_incoming_image(self, raw_ros_image):
-        """Convert and process an incoming ROS image"""
-        hsv_image = self._convert_raw_2_hsv(raw_ros_image)
+        """Hand an incoming ROS image to the worker, or process it right away"""
+        if self.frameMailbox is not None:
+            self.frameMailbox.put(raw_ros_image)
+        else:
+            self._handle_frame(raw_ros_image)
+
+    def _process_frames(self):
+        """Worker loop, always processes the newest frame in the mailbox"""
+        while not rospy.is_shutdown():
+            raw_ros_image, queue_age = self.frameMailbox.take(0.5)
+            if raw_ros_image is None:
+                continue
+            self.queueAge = queue_age
+            self.maxQueueAge = max(self.maxQueueAge, queue_age)
+            # a bad frame must not kill the worker thread, log it and take the next
+            try:
+                self._handle_frame(raw_ros_image)
+            except Exception, e:
+                rospy.logerr("Error processing frame: %s\n%s" % (e, traceback.format_exc()))
+
+    def _handle_frame(self, raw_ros_image):
+        """Convert and process a ROS image"""
+        start = time.time()
+        if not raw_ros_image.header.stamp.is_zero():
+            self.frameAge = (rospy.Time.now() - raw_ros_image.header.stamp).to_sec()
+        bgr_image = self._convert_raw_2_bgr(raw_ros_image)
         # objectPose topic published in _process_image
-        processed_image = self._process_image(hsv_image)
+        stamp = raw_ros_image.header.stamp
+        if stamp.is_zero():
+            stamp = rospy.Time.now()
+        rects = self._process_image(bgr_image, stamp)
         #center = self._find_center(mask)
         #if (center is not None) and (self.testing == True):
         #    velocity, rotation = self._follow_ball(center, (640, 480))
         #    print velocity, rotation
         #    self.drive_robot(velocity, rotation)
         #cv2.rectangle(hsv_image, gPoint1, gPoint2, [255, 255, 255], 2)
-        rgb_image = cv2.cvtColor(processed_image, cv2.COLOR_HSV2BGR)
-        ros_image = self.bridge.cv2_to_imgmsg(rgb_image, "bgr8")
-        self.image_pub.publish(ros_image)
+        if self.budget is None or self.budget.level()['debugImage']:
+            self._publish_debug_image(bgr_image, rects, stamp)
+        self.framesProcessed += 1
+        self.processingTime = time.time() - start
+        if self.budget is not None:
+            self.budget.record(self.processingTime)
+
+    # function to publish frame counters and ages on /diagnostics
+    def _publish_diagnostics(self, event):
+        values = [KeyValue('frames processed', str(self.framesProcessed)),
+                  KeyValue('frame age (ms)', '%.1f' % (1000 * self.frameAge))]
+        if self.frameMailbox is not None:
+            values += [KeyValue('frames received', str(self.frameMailbox.received)),
+                       KeyValue('frames dropped', str(self.frameMailbox.dropped)),
+                       KeyValue('queue age (ms)', '%.1f' % (1000 * self.queueAge)),
+                       KeyValue('max queue age (ms)', '%.1f' % (1000 * self.maxQueueAge))]
+        self.maxQueueAge = 0
+        values.append(KeyValue('processing time (ms)', '%.1f' % (1000 * self.processingTime)))
+        level = DiagnosticStatus.OK
+        message = 'processing'
+        if self.budget is not None:
+            values += [KeyValue('budget (ms)', '%.1f' % (1000 * self.budget.budget)),
+                       KeyValue('quality level', str(self.budget.index)),
+                       KeyValue('quality settings', str(self.budget.level()))]
+            if self.budget.index > 0:
+                level = DiagnosticStatus.WARN
+                message = 'over budget, degraded to quality level %d' % self.budget.index
+        status = DiagnosticStatus(level=level, name='camera_node',
+                                  message=message, values=values)
+        diagnostics = DiagnosticArray(status=[status])
+        diagnostics.header.stamp = rospy.Time.now()
+        self.diagnostics_pub.publish(diagnostics)
 
     def drive_robot(self, velocity, rotation):
         rospy.wait_for_service('requestDrive')
         try:
             service_request = rospy.ServiceProxy('requestDrive', requestDrive)
-            response = service_request(velocity, rotation)
+            response = service_request(velocity, rotation, rospy.Time(0))
         except rospy.ServiceException, e:
             print e
 
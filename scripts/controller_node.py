@@ -1,33 +1,91 @@
 #!/usr/bin/env python
 
 import rospy
-from robotics_project.msg import objectPose
+import actionlib
+from robotics_project.msg import objectPose, motionAction, motionGoal, driveCommand
 from robotics_project.srv import *
+from latency_trace import LatencyTracer
+from world_model import WorldModel
+from state_machine import State, StateMachine
+from approach_planner import ApproachPlanner
+from nav_msgs.msg import Odometry
 from code import interact
 import math
-from copy import copy
 
 class ControllerNode():
-    def __init__(self):
-        rospy.init_node('controller_node')
-        self.drive_request = rospy.ServiceProxy('requestDrive', requestDrive)
+    def __init__(self, start_node=True):
+        """Start controller_node and play soccer. With start_node False nothing
+        is connected to ROS, the caller sets drive_publisher and motion_client,
+        feeds the pose and odometry callbacks, ticks the state machine and
+        handles queued_events (soccer_simulator.py does)"""
+        self.start_node = start_node
+        if start_node:
+            rospy.init_node('controller_node')
+        self.objectPose = None
+        self.latency = LatencyTracer('controller_node', ['pose received', 'command sent'],
+                                     publish=start_node)
+        self.motion_feedback = None
+        self.motion_count = 0
+        self.motion_done = False
+        self.motion_result = None
+        # soccer attempt as a state machine, run by pose, motion and timer events
+        self.strike_dist = 20
+        self.max_variance = 100.0
+        self.planner = ApproachPlanner(self.strike_dist)
+        self.plan = None
+        # unaligned plans are planned again from where they end, but only so
+        # often (the ball may be stuck where no aligned plan can reach it)
+        self.max_replans = 3
+        self.replans = 0
+        self.aim_offset = 0.0
+        self.target_lost = False
+        # visual servoing: once behind the ball, drive at it continuously with
+        # rotation proportional to the bearing error instead of stop-and-go
+        # face/approach/aim moves
+        self.use_servoing = True
+        self.servo_turn_gain = 3.0          # rotation per degree of bearing error
+        self.servo_max_rotation = 100
+        self.servo_speed_gain = 10.0        # velocity per inch to the strike distance
+        self.servo_min_speed = 50
+        self.servo_max_speed = 300
+        self.servo_aligned = 5.0            # degrees of bearing error to strike within
+        self.servo_error = None
+        self.servo_distance = None
+        self.queued_events = []
+        self.machine = StateMachine(self.soccer_states(), 'wait_for_nodes',
+                                    0.1 if start_node else None)
+        if not start_node:
+            self.world = WorldModel()
+            self.drive_publisher = None
+            self.motion_client = None
+            return
+        # velocities go out on a topic, drive_node writes the newest one at a
+        # fixed rate and stops the robot if they stop coming
+        self.drive_publisher = rospy.Publisher('driveCommand', driveCommand, queue_size=1)
         self.angle_request = rospy.ServiceProxy('requestAngle', requestAngle)
-        self.distance_request = rospy.ServiceProxy('driveDist', driveDist)
-        self.turn_request = rospy.ServiceProxy('turnAngle', turnAngle)
-        self.strike_request= rospy.ServiceProxy('requestStrike', requestStrike)
+        # drives, turns and strikes are motion goals so the poses keep being
+        # looked at while the robot moves
+        self.motion_client = actionlib.SimpleActionClient('motion', motionAction)
+        # ball and goal positions from every objectPose, kept in the odometry
+        # frame so they stay valid while the robot moves
+        self.world = WorldModel(rospy.get_param('~image_width', 640),
+                                rospy.get_param('~horizontal_fov', 60.0))
+        self.odom_subscriber = rospy.Subscriber('odom', Odometry,
+                                                self.world.update_odometry)
         self.pose_subscriber = rospy.Subscriber(
                 "/camera_node/objectPose",
                 objectPose,
                 self.handle_incoming_pose
         )
-        rospy.sleep(10)
         print "playing soccer"
-        self.play_soccer()
+        self.machine.start()
         #self.test_angles()
         rospy.spin()
 
     def handle_incoming_pose(self, objectPose):
+        self.latency.record_since('pose received', objectPose.header.stamp)
         self.objectPose = objectPose
+        self.world.update_pose(objectPose)
         self.objectPose_dict = {
                 'ball_in_view':objectPose.ball_in_view,
                 'ball_center_x':objectPose.ball_center_x,
@@ -35,53 +93,16 @@ class ControllerNode():
                 'goal_center_x':objectPose.goal_center_x,
                 'ball_distance':objectPose.ball_distance
         }
-
-    def get_object_in_view(self, object_in_view):
-        while not self.objectPose_dict[object_in_view]: 
-            self.drive_robot(0, 40)
-            rospy.sleep(0.1)
-        rospy.sleep(0.5)
-        print "ball is in view"
-        self.drive_robot(0, 0)
-
-    def center_object(self, object_center):
-        offset = self.objectPose_dict[object_center] - 320
-        while abs(offset) > 20:
-            offset = self.objectPose_dict[object_center] - 320
-            #turn_rate = max([abs(offset)/(320/50), 25])
-            turn_rate = 30
-            self.drive_robot(0, turn_rate)
-        print "centered ball, sending stop command"
-        self.drive_robot(0, 0)
-
-    def get_behind_ball(self, goal_dist, ball_dist, angle, desired_dist):
-        behind_angle, behind_dist = self.calc_info_for_plan_nate1(goal_dist, ball_dist, angle, desired_dist)
-        return behind_angle, behind_dist
-
-    def calc_info_for_plan_nate1(self, goal_dist, ball_dist, angle, desired_dist):
-        # plan "nate1": get behind the ball at a 45 degree angle
-        # (so angle goal-ball-robot is 135 degrees) and 30" 
-        # from the ball
-        a = goal_dist
-        b = ball_dist
-        d = desired_dist
-        theta = angle * (math.pi / 180)
-        c = math.sqrt( (a*a)+(b*b)-(2*a*b*math.cos(theta)) )
-        rho = math.acos( ((a*a)-(b*b)-(c*c)) / (-2*b*c) )
-        #eta = 3*math.pi / 4
-        eta = math.pi - rho
-        x = math.sqrt( (b*b)+(d*d)-(2*b*d*math.cos(eta)) )
-        behind_angle_rad = math.acos( ((d*d)-(b*b)-(x*x)) / (-2*b*x) )
-        behind_angle = behind_angle_rad * (180 / math.pi)
-        behind_dist = x
-        return behind_angle, behind_dist
+        self.machine.handle_event('pose')
 
     def test_angles(self):
         angle1 = self.request_angle()
         print "Zeroing angle... ", angle1
-        self.drive_robot(0, 75)
         print "turning robot"
-        rospy.sleep(2)
+        end = rospy.get_time() + 2
+        while rospy.get_time() < end:
+            self.drive_robot(0, 75)
+            rospy.sleep(0.1)
         print "stopping robot"
         self.drive_robot(0, 0)
         angle2 = self.request_angle()
@@ -90,88 +111,235 @@ class ControllerNode():
         response = self.turn_angle(45)
         print response
 
-    def play_soccer(self):
-        print "Finding Goal"
-        self.get_object_in_view('goal_in_view')
-        print "Goal in view, centering..."
-        self.center_object('goal_center_x')
-        print "Goal found."
-        rospy.sleep(2)
-        goal_dist = copy(self.objectPose.goal_distance)
-        rospy.sleep(1.0)
-        print "Zeroing angle measurement..."
-        angle = self.request_angle()
-        print "Finding ball..."
-        self.get_object_in_view('ball_in_view')
-        print "Ball in view, centering..."
-        self.center_object('ball_center_x')
-        print "Ball found."
-        rospy.sleep(2)
-        ball_dist = copy(self.objectPose.ball_distance)
-        angle = self.request_angle()
-        desired_dist = 25
-        print "Angle between ball and goal: ", angle
-        print "Ball distance: ", ball_dist
-        print "Goal distance: ", goal_dist
-        rospy.sleep(.25)
-        behind_angle, behind_dist = self.get_behind_ball(goal_dist, ball_dist, angle, desired_dist)
-        behind_dist = behind_dist * 1.35    #shameless hack
-        behind_angle = behind_angle * 0.75
-        print "going to turn ", behind_angle
-        self.turn_angle(behind_angle)
-        rospy.sleep(.25)
-        print "going to move ", behind_dist
-        self.drive_distance(behind_dist)
-        print "Now behind ball."
-        rospy.sleep(.25)
-        self.get_object_in_view('ball_in_view')
-        self.center_object('ball_center_x')
-        rospy.sleep(.25)
-        rospy.sleep(2)
-        print "Ball is ", self.objectPose.ball_distance, " inches away."
-        print "Approaching ball..."
-        ball_diff = self.objectPose.ball_distance - 20
-        print "Driving ", ball_diff
-        drive_success = self.drive_distance(ball_diff)
-        print drive_success
-        rospy.sleep(.25)
-        print "Finding ball..."
-        self.get_object_in_view('ball_in_view')
-        print "Ball in view, centering..."
-        self.center_object('ball_center_x')
-        print "Ball found."
-        print "Striking!"
-        self.request_strike()
+    def soccer_states(self):
+        """
+        wait for the camera and drive nodes, turn until the world model has
+        the ball and the goal, turn and drive to the approach point the
+        planner picks (planning again from there when the ball was in the
+        way, at most max_replans times), face the ball and approach it (re-aiming whenever it drifts off
+        center) until it is close enough to strike. With use_servoing the
+        facing, approach and aiming are one continuous servo onto the ball
+        """
+        approach_state = 'servo' if self.use_servoing else 'face_ball'
+        return [
+            State('wait_for_nodes', exits=[(self.nodes_ready, 'search')]),
+            State('search', during=self.spin_search,
+                  exits=[(lambda: self.known('ball', 'goal'), 'turn_behind')],
+                  timeout=(30, 'gave_up')),
+            State('turn_behind', enter=self.start_turn_behind,
+                  exits=[(lambda: self.plan is None, approach_state),
+                         (self.motion_finished, 'drive_behind')]),
+            State('drive_behind', enter=self.start_drive_behind,
+                  exits=[(lambda: (self.motion_finished() and not self.plan.aligned and
+                                   self.replans < self.max_replans), 'turn_behind'),
+                         (self.motion_finished, approach_state)]),
+            State('face_ball', enter=self.start_face_ball,
+                  exits=[(lambda: self.target_lost, 'search_ball'),
+                         (self.motion_finished, 'approach')]),
+            State('search_ball', during=self.spin_search,
+                  exits=[(lambda: self.known('ball'), approach_state)],
+                  timeout=(30, 'gave_up')),
+            State('approach', enter=self.start_approach,
+                  exits=[(self.ball_off_center, 'aim'),
+                         (self.motion_finished, 'aim')]),
+            State('aim', enter=self.start_face_ball,
+                  exits=[(lambda: self.target_lost, 'search_ball'),
+                         (lambda: self.motion_finished() and self.ball_close(), 'strike'),
+                         (self.motion_finished, 'approach')]),
+            State('servo', enter=self.start_servo, during=self.servo_ball,
+                  exits=[(lambda: self.target_lost, 'search_ball'),
+                         (self.servo_ready, 'strike')]),
+            State('strike', enter=lambda: self.start_motion(motionGoal.STRIKE, 0),
+                  exits=[(self.motion_finished, 'struck')]),
+            State('struck', enter=lambda: self.drive_robot(0, 0)),
+            State('gave_up', enter=lambda: self.drive_robot(0, 0)),
+        ]
+
+    def nodes_ready(self):
+        return (self.objectPose is not None and
+                self.motion_client.wait_for_server(rospy.Duration(0.01)))
+
+    def known(self, *names):
+        now = rospy.get_time()
+        return all(self.world.view(name, now) is not None for name in names)
+
+    def spin_search(self):
+        self.drive_robot(0, 40)
+
+    def start_turn_behind(self):
+        self.drive_robot(0, 0)
+        now = rospy.get_time()
+        ball = self.world.view('ball', now)
+        goal = self.world.view('goal', now)
+        print "Ball at ", ball.x, ball.y, " (", ball.distance, " in)"
+        print "Goal at ", goal.x, goal.y, " (", goal.distance, " in)"
+        self.plan = self.planner.plan((ball.x, ball.y), (goal.x, goal.y))
+        print "plan: ", self.plan
+        if self.plan is None:
+            return
+        if not self.plan.aligned:
+            self.replans += 1
+        self.aim_offset = self.plan.heading_offset if self.plan.aligned else 0.0
+        self.start_motion(motionGoal.TURN, self.plan.turn)
+
+    def start_drive_behind(self):
+        print "turned ", getattr(self.motion_result, 'achieved', None)
+        print "going to move ", self.plan.drive
+        self.start_motion(motionGoal.DRIVE, self.plan.drive)
+
+    def start_face_ball(self):
+        """Turn to the ball's estimate, or flag it lost when it is too uncertain"""
+        self.drive_robot(0, 0)
+        view = self.world.view('ball', rospy.get_time())
+        self.target_lost = view is None or view.variance > self.max_variance
+        if self.target_lost:
+            self.world.forget('ball')
+        elif abs(view.bearing + self.aim_offset) > 3:
+            # turns are clockwise for positive degrees, the planned strike
+            # heading is aim_offset counterclockwise of the ball
+            self.start_motion(motionGoal.TURN, -(view.bearing + self.aim_offset))
+        else:
+            self.motion_done = True
+
+    def start_approach(self):
+        ball = self.world.view('ball', rospy.get_time())
+        print "Ball is ", ball.distance, " inches away, approaching"
+        self.start_motion(motionGoal.DRIVE, ball.distance - self.strike_dist)
+
+    def start_servo(self):
+        self.servo_error = None
+        self.servo_distance = None
+        self.servo_ball()
+
+    def servo_ball(self):
+        """
+        Stream one velocity command steering at the ball, from the latest
+        objectPose when it sees the ball and from the world model otherwise
+        """
+        now = rospy.get_time()
+        view = self.world.view('ball', now)
+        self.target_lost = view is None or view.variance > self.max_variance
+        if self.target_lost:
+            self.world.forget('ball')
+            self.drive_robot(0, 0)
+            return
+        pose = self.objectPose
+        if (pose.ball_in_view and pose.ball_distance > 0 and
+                now - pose.header.stamp.to_sec() < 0.2):
+            bearing = math.degrees(self.world.bearing(pose.ball_center_x))
+            distance = pose.ball_distance
+        else:
+            bearing = view.bearing
+            distance = view.distance
+        # error is counterclockwise of the planned strike heading, positive
+        # rotation turns clockwise
+        error = bearing + self.aim_offset
+        rotation = max(-self.servo_max_rotation,
+                       min(self.servo_max_rotation, -self.servo_turn_gain * error))
+        velocity = max(self.servo_min_speed,
+                       min(self.servo_max_speed,
+                           self.servo_speed_gain * (distance - self.strike_dist)))
+        # slow down while the ball is well off the heading, turning in place
+        # when it is more than 30 degrees off
+        velocity *= max(0.0, 1 - abs(error) / 30.0)
+        self.servo_error = error
+        self.servo_distance = distance
+        self.drive_robot(int(velocity), int(rotation))
+
+    def servo_ready(self):
+        return (self.servo_error is not None and
+                abs(self.servo_error) < self.servo_aligned and
+                self.servo_distance < self.strike_dist + 5)
+
+    def ball_close(self):
+        ball = self.world.view('ball', rospy.get_time())
+        return ball is not None and ball.distance < self.strike_dist + 5
+
+    # stamp of the camera frame the next command is based on, sent along
+    # with it so drive_node can trace the latency up to the serial write
+    def pose_stamp(self):
+        if self.objectPose is None:
+            return rospy.Time(0)
+        return self.objectPose.header.stamp
+
+    # function to trace the latency from the camera frame at stamp to a
+    # command having gone out
+    def record_command_sent(self, stamp):
+        if not stamp.is_zero():
+            self.latency.record_since('command sent', stamp)
 
     def drive_robot(self, velocity, rotation):
-        rospy.wait_for_service('requestDrive')
-        try:
-            self.drive_request(velocity, rotation)
-        except rospy.ServiceException, e:
-            print e
+        """Publish a velocity, it has to be repeated faster than drive_node's
+        command timeout (0.5 s) or the robot stops"""
+        command = driveCommand(velocity=velocity, rotation=rotation)
+        command.header.stamp = self.pose_stamp()
+        self.drive_publisher.publish(command)
+        self.record_command_sent(command.header.stamp)
 
-    def drive_distance(self, distance):
-        rospy.wait_for_service('driveDist')
-        try:
-            response = self.distance_request(distance)
-        except rospy.ServiceException, e:
-            print e
-        return response
+    def ball_off_center(self):
+        """True when the ball is in view but drifted away from where the aim
+        puts it (the image center for no aim_offset), out of view the world
+        model still knows where it is"""
+        expected_x = (self.world.image_center_x +
+                      self.world.focal_length * math.tan(math.radians(self.aim_offset)))
+        return (self.objectPose_dict['ball_in_view'] and
+                abs(self.objectPose_dict['ball_center_x'] - expected_x) > 80)
 
-    def turn_angle(self, degrees):
-        rospy.wait_for_service('turnAngle')
-        try:
-            response = self.turn_request(degrees)
-        except rospy.ServiceException, e:
-            print e
-        return response
+    def start_motion(self, motion_type, amount):
+        """Send a motion goal without waiting for it, preempts the running goal"""
+        self.motion_client.wait_for_server()
+        goal = motionGoal(type=motion_type, amount=amount, pose_stamp=self.pose_stamp())
+        self.motion_feedback = None
+        self.motion_done = False
+        self.motion_count += 1
+        count = self.motion_count
+        self.motion_client.send_goal(
+                goal, feedback_cb=self.handle_motion_feedback,
+                done_cb=lambda status, result: self.handle_motion_done(count, result))
+        self.record_command_sent(goal.pose_stamp)
 
-    def request_strike(self):
-        rospy.wait_for_service('requestStrike')
-        try:
-            self.strike_request()
-        except rospy.ServiceException, e:
-            print e
+    def handle_motion_feedback(self, feedback):
+        self.motion_feedback = feedback
+
+    def handle_motion_done(self, count, result):
+        # a preempted goal finishing is not news for the goal that replaced it
+        if count != self.motion_count:
+            return
+        self.motion_result = result
+        self.motion_done = True
+        self.post_event('motion done')
+
+    def post_event(self, event):
+        """Handle event on a timer thread, the state entered next may send a
+        goal from it, headless the event is queued for the caller instead"""
+        if not self.start_node:
+            self.queued_events.append(event)
+            return
+        rospy.Timer(rospy.Duration(0.001),
+                    lambda timer_event: self.machine.handle_event(event), oneshot=True)
+
+    def motion_finished(self):
+        return self.motion_done
+
+    def wait_motion(self, abort_if=None):
+        """
+        Wait for the running motion goal and return its result. abort_if is
+        checked against the latest pose while waiting, the goal is cancelled
+        as soon as it returns True
+        """
+        while not self.motion_client.wait_for_result(rospy.Duration(0.05)):
+            if rospy.is_shutdown():
+                break
+            if abort_if is not None and abort_if():
+                print "Cancelling motion after ", getattr(self.motion_feedback, 'achieved', 0)
+                self.motion_client.cancel_goal()
+                self.motion_client.wait_for_result()
+                break
+        return self.motion_client.get_result()
+
+    def turn_angle(self, degrees, abort_if=None):
+        self.start_motion(motionGoal.TURN, degrees)
+        return self.wait_motion(abort_if)
 
     def request_angle(self):
         rospy.wait_for_service('requestAngle')
@@ -181,19 +349,5 @@ class ControllerNode():
             print e
         return angle.angle
 
-    def build_model(self, objectPose):
-        """Calculate world coordinates of ball and goal, robot is (0,0)"""
-        if objectPose.ball_in_view:
-            ball_distance = objectPose.ball_distance
-            ball_offset = objectPose.ball_center_x
-            ball_coords = calculate_object_coords(ball_distance, ball_offset)
-        if objectPose.goal_in_view:
-            goal_distance = objectPose.goal_distance
-            goal_offset = objectPose.goal_center_x
-            goal_coords = calculate_object_coords(goal_distance, goal_offset)
-
-    def calculate_object_coords(self, distance, offset): 
-        pass
-
 if __name__ == "__main__":
     controller_node = ControllerNode()
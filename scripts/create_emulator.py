@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+# Software stand-in for an iRobot Create 2 on a pseudo terminal, so drive_node
+# can be run and timed without the robot. It answers the Open Interface
+# opcodes drive_node sends, moves a differential drive model whose encoder
+# counts wrap around like the real ones, and can add serial latency, a baud
+# rate limit and corrupted bytes.
+#
+# usage: create_emulator.py [--latency 0.002] [--baud 115200] [--error-rate 0.0]
+#        then: rosrun robotics_project drive_node.py _port:=<printed pty>
+
+import os
+import tty
+import math
+import time
+import random
+import struct
+import argparse
+import threading
+from drive_node import sensor_packet_formats
+
+# argument bytes after each fixed length opcode
+opcode_args = {7: 0, 128: 0, 131: 0, 132: 0, 141: 1, 142: 1, 143: 0, 145: 4, 150: 1, 173: 0}
+# Open Interface mode (packet 35) after each mode opcode
+opcode_modes = {7: 0, 128: 1, 131: 2, 132: 3, 173: 0}
+
+class Create2Emulator():
+    """Create 2 on a pty, drive_node opens slave_name as its serial port"""
+    mm_per_count = (math.pi * 72) / 508.8
+    wheel_base = 235.0
+
+    def __init__(self, latency=0.0, baud=115200, error_rate=0.0, start_counts=65000,
+                 period=0.015, seed=None):
+        self.latency = latency
+        self.byte_time = 10.0 / baud    # start bit, 8 data bits and a stop bit
+        self.error_rate = error_rate
+        self.period = period
+        self.random = random.Random(seed)
+        # counts start close to 65535 so the first meters of driving wrap them
+        self.start_counts = start_counts
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.slave_name = os.ttyname(self.slave)
+        self.write_lock = threading.Lock()
+        self.mode = 0
+        self.velocity = (0, 0)          # requested left, right wheel mm/s
+        self.wheel_mm = [0.0, 0.0]
+        self.x = self.y = self.heading = 0.0
+        self.distance_since_read = 0.0
+        self.angle_since_read = 0.0
+        self.stream_ids = []
+        self.streaming = False
+        self.opcode_counts = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.errors_injected = 0
+        self.running = True
+        self.threads = [threading.Thread(target=self.read_commands),
+                        threading.Thread(target=self.simulate)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        self.running = False
+        os.close(self.slave)
+        os.close(self.master)
+
+    def command_length(self, buffer):
+        """Length of the command at the start of buffer, None until it is all there"""
+        opcode = buffer[0]
+        if opcode in opcode_args:
+            return 1 + opcode_args[opcode]
+        if opcode in (148, 149):
+            return 2 + buffer[1] if len(buffer) > 1 else None
+        if opcode == 140:
+            return 3 + 2 * buffer[2] if len(buffer) > 2 else None
+        # unknown opcodes are dropped one byte at a time
+        return 1
+
+    def read_commands(self):
+        buffer = bytearray()
+        while self.running:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                break
+            # the bytes can't have arrived faster than the baud rate allows
+            time.sleep(len(data) * self.byte_time)
+            self.bytes_in += len(data)
+            buffer.extend(data)
+            while buffer:
+                length = self.command_length(buffer)
+                if length is None or len(buffer) < length:
+                    break
+                self.execute(buffer[:length])
+                del buffer[:length]
+
+    def execute(self, command):
+        opcode = command[0]
+        self.opcode_counts[opcode] = self.opcode_counts.get(opcode, 0) + 1
+        if opcode in opcode_modes:
+            self.mode = opcode_modes[opcode]
+            if self.mode == 0:
+                self.streaming = False
+                self.velocity = (0, 0)
+        elif opcode == 145:
+            vr, vl = struct.unpack('>hh', bytes(command[1:5]))
+            # like the robot, drive commands only count in safe and full mode
+            if self.mode >= 2:
+                self.velocity = (max(-500, min(500, vl)), max(-500, min(500, vr)))
+        elif opcode == 142:
+            self.send(self.pack_packets([command[1]]))
+        elif opcode == 149:
+            self.send(self.pack_packets(list(command[2:])))
+        elif opcode == 148:
+            self.stream_ids = list(command[2:])
+            self.streaming = True
+        elif opcode == 150:
+            self.streaming = bool(command[1]) and bool(self.stream_ids)
+
+    def encoder_counts(self, wheel):
+        return (self.start_counts + int(round(self.wheel_mm[wheel] / self.mm_per_count))) & 0xFFFF
+
+    def packet_value(self, packet_id):
+        if packet_id == 19:
+            value = int(round(self.distance_since_read))
+            self.distance_since_read -= value
+        elif packet_id == 20:
+            value = int(round(self.angle_since_read))
+            self.angle_since_read -= value
+        elif packet_id == 35:
+            value = self.mode
+        elif packet_id == 39:
+            value = (self.velocity[0] + self.velocity[1]) / 2
+        elif packet_id == 41:
+            value = self.velocity[1]
+        elif packet_id == 42:
+            value = self.velocity[0]
+        elif packet_id == 43:
+            value = self.encoder_counts(0)
+        elif packet_id == 44:
+            value = self.encoder_counts(1)
+        else:
+            value = 0
+        return value
+
+    def pack_packets(self, packet_ids):
+        return ''.join(struct.pack('>' + sensor_packet_formats[packet_id],
+                                   self.packet_value(packet_id))
+                       for packet_id in packet_ids)
+
+    def stream_frame(self):
+        """[19][n][id 1][data 1]...[checksum], all bytes summing to 0 mod 256"""
+        payload = ''.join(struct.pack('B', packet_id) + self.pack_packets([packet_id])
+                          for packet_id in self.stream_ids)
+        frame = struct.pack('BB', 19, len(payload)) + payload
+        checksum = -sum(bytearray(frame)) & 0xFF
+        return frame + struct.pack('B', checksum)
+
+    def send(self, data):
+        data = bytearray(data)
+        if self.error_rate:
+            for index in range(len(data)):
+                if self.random.random() < self.error_rate:
+                    data[index] ^= 1 << self.random.randrange(8)
+                    self.errors_injected += 1
+        with self.write_lock:
+            time.sleep(self.latency + len(data) * self.byte_time)
+            try:
+                os.write(self.master, bytes(data))
+            except OSError:
+                return
+            self.bytes_out += len(data)
+
+    def simulate(self):
+        """Move the robot every period and send a stream frame when streaming"""
+        last = time.time()
+        while self.running:
+            time.sleep(self.period)
+            now = time.time()
+            dt = now - last
+            last = now
+            left_mm = self.velocity[0] * dt
+            right_mm = self.velocity[1] * dt
+            self.wheel_mm[0] += left_mm
+            self.wheel_mm[1] += right_mm
+            dist = (left_mm + right_mm) / 2.0
+            turn = (right_mm - left_mm) / self.wheel_base
+            self.x += dist * math.cos(self.heading + turn / 2.0)
+            self.y += dist * math.sin(self.heading + turn / 2.0)
+            self.heading += turn
+            self.distance_since_read += dist
+            self.angle_since_read += math.degrees(turn)
+            if self.streaming:
+                self.send(self.stream_frame())
+
+    def stats(self):
+        return "%d bytes in, %d bytes out, %d corrupted, opcodes %s" % (
+                self.bytes_in, self.bytes_out, self.errors_injected,
+                ' '.join('%d:%d' % item for item in sorted(self.opcode_counts.items())))
+
+def main():
+    parser = argparse.ArgumentParser(description='Create 2 emulator on a pty')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added before every reply')
+    parser.add_argument('--baud', type=int, default=115200, help='serial baud rate')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='chance of corrupting each byte sent')
+    args = parser.parse_args()
+    emulator = Create2Emulator(args.latency, args.baud, args.error_rate)
+    print "Create 2 emulator on", emulator.slave_name
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print emulator.stats()
+        emulator.close()
+
+if __name__ == "__main__":
+    main()
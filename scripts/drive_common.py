@@ -0,0 +1,79 @@
+# Pieces of drive_node shared with the controller side and the simulator,
+# kept apart from the node so importing them doesn't need serial or actionlib.
+
+import math
+import bisect
+from collections import namedtuple
+
+# odometry pose at one sensor reading, x and y in mm from where the node started
+# and heading in radians counterclockwise, not wrapped so differences are turns
+OdometryPose = namedtuple('OdometryPose', ['stamp', 'x', 'y', 'heading'])
+
+# function to return the pose at stamp from a time ordered list of poses,
+# interpolating between the readings either side and clamping at the ends
+def interpolate_pose(history, stamp):
+    stamps = [pose.stamp for pose in history]
+    index = bisect.bisect_left(stamps, stamp)
+    if index == 0:
+        return history[0]
+    if index == len(history):
+        return history[-1]
+    before, after = history[index - 1], history[index]
+    t = (stamp - before.stamp) / (after.stamp - before.stamp)
+    return OdometryPose(stamp, before.x + t * (after.x - before.x),
+                        before.y + t * (after.y - before.y),
+                        before.heading + t * (after.heading - before.heading))
+
+# how DriveNode drives: encoder reading period (s), distances in mm, speeds in
+# mm/s per wheel and ramps in mm/s^2 for the closed loop moves and strikes,
+# command rate (Hz) and timeout (s) of the driveCommand topic. The approach
+# planner's drive model and soccer_simulator.py's stand-in use them too
+DriveSettings = namedtuple('DriveSettings', [
+        'sensor_period', 'wheel_base', 'drive_speed', 'turn_speed', 'move_accel',
+        'move_decel', 'move_min_speed', 'move_tolerance', 'move_sync_gain',
+        'strike_speed', 'strike_time', 'command_rate', 'command_timeout'])
+drive_settings = DriveSettings(
+        sensor_period=0.015, wheel_base=235.0, drive_speed=300, turn_speed=100,
+        move_accel=500.0, move_decel=400.0, move_min_speed=20.0, move_tolerance=3.0,
+        move_sync_gain=4.0,     # mm/s of correction per mm a wheel is off
+        strike_speed=500, strike_time=1.5, command_rate=20, command_timeout=0.5)
+
+class MoveProfile():
+    """
+    Wheel speeds for a closed loop move of the wheels left_mm and right_mm.
+    Both wheels follow one trapezoidal profile along the longer of the two
+    paths, each wheel's speed is corrected by how far it is ahead of or
+    behind where that profile puts it so they start and stop together.
+    Moves shorter than the tolerance must not be started.
+    """
+    def __init__(self, left_mm, right_mm, max_speed, now, settings=drive_settings):
+        self.length = max(abs(left_mm), abs(right_mm))
+        self.left_share = left_mm / self.length
+        self.right_share = right_mm / self.length
+        self.max_speed = max_speed
+        self.settings = settings
+        self.speed = 0.0
+        self.last_time = now
+        self.deadline = now + 2.0 + 2.0 * self.length / max_speed
+
+    def update(self, left_done, right_done, now):
+        """(left, right) speeds to drive at the encoder reading where the
+        wheels have moved left_done and right_done mm, None once the move is
+        done or out of time"""
+        s = self.settings
+        # progress along the profile is the average of the moving wheels' progress
+        progresses = [done / share for done, share in
+                      ((left_done, self.left_share), (right_done, self.right_share)) if share]
+        progress = sum(progresses) / len(progresses)
+        remaining = self.length - progress
+        if remaining < s.move_tolerance or now > self.deadline:
+            return None
+        dt = max(now - self.last_time, s.sensor_period)
+        self.last_time = now
+        self.speed = min(self.max_speed, self.speed + s.move_accel * dt,
+                         math.sqrt(2 * s.move_decel * remaining))
+        self.speed = max(self.speed, s.move_min_speed)
+        return (self.speed * self.left_share +
+                s.move_sync_gain * (progress * self.left_share - left_done),
+                self.speed * self.right_share +
+                s.move_sync_gain * (progress * self.right_share - right_done))
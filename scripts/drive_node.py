@@ -4,16 +4,139 @@ import serial
 import math
 import rospy
 import struct
+import threading
+import actionlib
+from collections import namedtuple, deque
 from robotics_project.srv import *
+from robotics_project.msg import (motionAction, motionGoal, motionFeedback, motionResult,
+                                  driveCommand)
+from latency_trace import LatencyTracer
+from nav_msgs.msg import Odometry
+from drive_common import OdometryPose, interpolate_pose, drive_settings, MoveProfile
+
+# struct format of every single Open Interface sensor packet, by packet id
+sensor_packet_formats = {
+    7: 'B',     # bumps and wheel drops
+    8: 'B', 9: 'B', 10: 'B', 11: 'B', 12: 'B', 13: 'B',     # wall, cliffs, virtual wall
+    14: 'B', 15: 'B', 16: 'B', 17: 'B', 18: 'B',            # overcurrents, dirt, ir, buttons
+    19: 'h',    # distance since last read (mm)
+    20: 'h',    # angle since last read (degrees)
+    21: 'B', 22: 'H', 23: 'h', 24: 'b', 25: 'H', 26: 'H',   # charging and battery
+    27: 'H', 28: 'H', 29: 'H', 30: 'H', 31: 'H',            # wall and cliff signals
+    32: 'B', 33: 'H', 34: 'B', 35: 'B', 36: 'B', 37: 'B', 38: 'B',
+    39: 'h', 40: 'h', 41: 'h', 42: 'h',                     # requested velocities
+    43: 'H',    # left encoder counts
+    44: 'H',    # right encoder counts
+    45: 'B', 46: 'H', 47: 'H', 48: 'H', 49: 'H', 50: 'H', 51: 'H',  # light bumper
+    52: 'B', 53: 'B', 54: 'h', 55: 'h', 56: 'h', 57: 'h', 58: 'B',
+}
+
+# latest values from the sensor stream, angle is summed over the stream and
+# packets holds the raw value of every streamed packet by id
+SensorSample = namedtuple('SensorSample', ['stamp', 'left', 'right', 'angle', 'bumps',
+                                           'packets'])
+
+# function to return the signed change between two 16 bit encoder readings,
+# the counts wrap around at 65535 in either direction
+def count_delta(new, old):
+    delta = (new - old) & 0xFFFF
+    if delta >= 0x8000:
+        delta -= 0x10000
+    return delta
+
+# newest command from the driveCommand topic, received is the local time it came in
+VelocityCommand = namedtuple('VelocityCommand', ['velocity', 'rotation', 'stamp', 'received'])
+
+class SensorStreamParser():
+    """Split the bytes of a Create 2 sensor stream (opcode 148) into samples
+
+    A frame is [19][n][id 1][data 1]...[id k][data k][checksum] and all its
+    bytes sum to 0 mod 256. Anything that doesn't check out is skipped one
+    byte at a time until the next good frame.
+    """
+    header = 19
+
+    def __init__(self, packet_ids):
+        self.packet_ids = list(packet_ids)
+        layout = '>' + ''.join('B' + sensor_packet_formats[packet_id]
+                               for packet_id in self.packet_ids)
+        self.payload_struct = struct.Struct(layout)
+        self.frame_size = self.payload_struct.size + 3
+        self.header_byte = struct.pack('B', self.header)
+        self.buffer = bytearray()
+        self.bad_frames = 0
+
+    def feed(self, data):
+        """Add bytes read from the robot, returns a {packet id: value} dict
+        for every complete frame"""
+        self.buffer.extend(data)
+        samples = []
+        while True:
+            start = self.buffer.find(self.header_byte)
+            if start < 0:
+                del self.buffer[:]
+                break
+            del self.buffer[:start]
+            if len(self.buffer) < self.frame_size:
+                break
+            if (self.buffer[1] != self.payload_struct.size or
+                    sum(self.buffer[:self.frame_size]) & 0xFF != 0):
+                self.bad_frames += 1
+                del self.buffer[:1]
+                continue
+            values = self.payload_struct.unpack_from(bytes(self.buffer[:self.frame_size]), 2)
+            if list(values[0::2]) != self.packet_ids:
+                self.bad_frames += 1
+                del self.buffer[:1]
+                continue
+            samples.append(dict(zip(values[0::2], values[1::2])))
+            del self.buffer[:self.frame_size]
+        return samples
 
 class DriveNode():
     def __init__(self):
         self.connection = None
-        self.encoder_max = 65535
         self.drive_struct = struct.Struct('>Bhh')
-        self.angle_struct = struct.Struct('>BB')
-        self.right_encoder_request, self.left_encoder_request = self.make_angle_request()
         self.port = '/dev/ttyUSB0'
+        self.baudrate = 115200
+        # have the robot stream encoders, angle and bumpers every 15 ms and
+        # read them from the latest sample instead of asking for them
+        self.use_sensor_stream = True
+        self.stream_packets = [43, 44, 20, 7]
+        self.sensor_period = drive_settings.sensor_period
+        self.sensor_sample = None
+        self.stream_parser = SensorStreamParser(self.stream_packets)
+        self.stream_running = False
+        self.stream_paused = False
+        self.serial_read_lock = threading.Lock()
+        self.query_structs = {}
+        # closed loop moves for driveDist and turnAngle, distances in mm and
+        # speeds in mm/s per wheel
+        self.wheel_packets = (43, 44)   # encoders of the physical left, right wheel
+        self.mm_per_count = (math.pi * 72) / 508.8
+        self.wheel_base = drive_settings.wheel_base
+        # odometry integrated from every encoder reading, the last
+        # odometry_history seconds of it are kept for requestPose
+        self.odometry_history = 10.0
+        self.odometry_poses = deque(maxlen=int(self.odometry_history / self.sensor_period))
+        self.odometry_lock = threading.Lock()
+        self.odometry_pose = OdometryPose(0.0, 0.0, 0.0, 0.0)
+        self.last_wheel_counts = None
+        self.angle_heading = 0.0
+        self.drive_speed = drive_settings.drive_speed
+        self.turn_speed = drive_settings.turn_speed
+        self.move_tolerance = drive_settings.move_tolerance
+        self.strike_speed = drive_settings.strike_speed
+        self.strike_time = drive_settings.strike_time
+        # one move at a time, whether it came from a service or a motion goal
+        self.motion_lock = threading.Lock()
+        # driveCommand topic: the newest command is written at command_rate,
+        # unchanged commands are not resent and the robot is stopped when no
+        # command came in for command_timeout seconds
+        self.command_rate = drive_settings.command_rate
+        self.command_timeout = drive_settings.command_timeout
+        self.velocity_command = None
+        self.last_drive_cmd = None
         self.command_dict = {
             'start':self.make_raw_command('128'),
             'safe':self.make_raw_command('131'),
@@ -25,6 +148,11 @@ class DriveNode():
             'reset':self.make_raw_command('7')
         }
         rospy.init_node('drive_node')
+        # the port can point at create_emulator.py's pty instead of the robot
+        self.port = rospy.get_param('~port', self.port)
+        self.baudrate = rospy.get_param('~baudrate', self.baudrate)
+        self.latency = LatencyTracer('drive_node', ['serial write'])
+        self.odometry_publisher = rospy.Publisher('odom', Odometry, queue_size=1)
         self.drive_service = rospy.Service('requestDrive', requestDrive,
                                  self.handle_requestDrive)
         self.turn_service = rospy.Service('turnAngle', turnAngle,
@@ -33,27 +161,92 @@ class DriveNode():
                                  self.handle_driveDist)
         self.angle_service = rospy.Service('requestAngle', requestAngle,
                                            self.handle_requestAngle)
+        self.pose_service = rospy.Service('requestPose', requestPose,
+                                          self.handle_requestPose)
+        self.sensors_service = rospy.Service('requestSensors', requestSensors,
+                                             self.handle_requestSensors)
         self.strike_service = rospy.Service('requestStrike', requestStrike,
                                             self.strike_forward)
         self.connect_robot()
-        self.encoder_count_reset()
+        if not self.stream_running:
+            self.odometry_timer = rospy.Timer(rospy.Duration(self.sensor_period),
+                                              self.poll_odometry)
+        # goal based version of driveDist, turnAngle and requestStrike, a new
+        # goal preempts the running one
+        self.motion_server = actionlib.SimpleActionServer('motion', motionAction,
+                                                          self.execute_motion, False)
+        self.motion_server.start()
+        self.command_subscriber = rospy.Subscriber('driveCommand', driveCommand,
+                                                   self.handle_driveCommand, queue_size=1)
+        self.command_writer = threading.Thread(target=self.write_velocity_commands)
+        self.command_writer.daemon = True
+        self.command_writer.start()
         rospy.spin()
 
     def strike_forward(self, request):
-        vel = 500
-        rot = 0
-        strike_cmd = self.make_drive_command(vel, rot)
+        self.run_strike(self.strike_time, request.pose_stamp)
+
+    def run_strike(self, duration, pose_stamp=None, feedback=None, preempted=None):
+        """Drive forward at strike speed for duration seconds, returns the seconds driven"""
+        strike_cmd = self.make_drive_command(self.strike_speed, 0)
         stop_cmd = self.make_drive_command(0,0)
-        print "Strike_cmd", strike_cmd
-        print "stop_cmd", stop_cmd
-        self.connection.write(strike_cmd)
-        rospy.sleep(1.5)
-        self.connection.write(stop_cmd)
+        with self.motion_lock:
+            start = rospy.get_time()
+            self.write_drive(strike_cmd)
+            self.latency.record_since('serial write', pose_stamp)
+            elapsed = 0.0
+            while elapsed < duration and not rospy.is_shutdown():
+                if preempted is not None and preempted():
+                    break
+                if feedback is not None:
+                    feedback(elapsed)
+                rospy.sleep(self.sensor_period)
+                elapsed = rospy.get_time() - start
+            self.write_drive(stop_cmd)
+        return min(elapsed, duration)
+
+    def write_drive(self, drive_command):
+        """Write a drive command, remembering it so the driveCommand writer
+        doesn't send it again"""
+        self.connection.write(drive_command)
+        self.last_drive_cmd = drive_command
+
+    def handle_driveCommand(self, command):
+        self.velocity_command = VelocityCommand(command.velocity, command.rotation,
+                                                command.header.stamp, rospy.get_time())
+
+    def write_velocity_commands(self):
+        """Writer thread for the driveCommand topic"""
+        rate = rospy.Rate(self.command_rate)
+        while not rospy.is_shutdown():
+            rate.sleep()
+            command = self.velocity_command
+            if command is None:
+                continue
+            stale = rospy.get_time() - command.received > self.command_timeout
+            if stale:
+                drive_command = self.make_drive_command(0, 0)
+            else:
+                drive_command = self.make_drive_command(command.velocity, command.rotation)
+            # moves from the services and motion goals own the wheels while they run
+            if drive_command != self.last_drive_cmd and self.motion_lock.acquire(False):
+                try:
+                    self.write_drive(drive_command)
+                finally:
+                    self.motion_lock.release()
+                if not stale:
+                    self.latency.record_since('serial write', command.stamp)
+            if stale and self.velocity_command is command:
+                # stop once per stale command, leaving requestDrive speeds alone
+                self.velocity_command = None
 
     def make_drive_command(self, vel, rot):
+        return self.make_wheel_command(vel + rot, vel - rot)
+
+    def make_wheel_command(self, vl, vr):
         #this is to keep vl and vr between -500 and 500 
-        vl = sorted([-500, vel + rot, 500])[1]
-        vr = sorted([-500, vel - rot, 500])[1]
+        vl = int(sorted([-500, vl, 500])[1])
+        vr = int(sorted([-500, vr, 500])[1])
         cmd = self.drive_struct.pack(145, vr, vl)
         return cmd
 
@@ -71,7 +264,7 @@ class DriveNode():
         try:
             self.connection = serial.Serial(
                     self.port,
-                    baudrate=115200,
+                    baudrate=self.baudrate,
                     timeout=1
             )
             print "Connected to robot."
@@ -81,117 +274,270 @@ class DriveNode():
             self.connection.write(self.command_dict['start'])
             self.connection.write(self.command_dict['full'])
             self.connection.write(self.command_dict['beep'])
+            if self.use_sensor_stream:
+                self.start_sensor_stream()
+
+    def start_sensor_stream(self):
+        stream_cmd = struct.pack('>BB', 148, len(self.stream_packets))
+        stream_cmd += struct.pack('>%dB' % len(self.stream_packets), *self.stream_packets)
+        self.connection.write(stream_cmd)
+        self.stream_running = True
+        self.stream_reader = threading.Thread(target=self.read_sensor_stream)
+        self.stream_reader.daemon = True
+        self.stream_reader.start()
+        rospy.on_shutdown(self.stop_sensor_stream)
+
+    def stop_sensor_stream(self):
+        self.stream_running = False
+        self.connection.write(struct.pack('>BB', 150, 0))
+
+    def read_sensor_stream(self):
+        """Reader thread, keeps self.sensor_sample up to date"""
+        while not rospy.is_shutdown():
+            if self.stream_paused:
+                rospy.sleep(self.sensor_period)
+                continue
+            with self.serial_read_lock:
+                data = self.connection.read(max(1, self.connection.inWaiting()))
+                samples = self.stream_parser.feed(data)
+            for values in samples:
+                stamp = rospy.get_time()
+                angle = values[20]
+                if self.sensor_sample is not None:
+                    angle += self.sensor_sample.angle
+                # replacing the whole tuple keeps readers from seeing half a sample
+                self.sensor_sample = SensorSample(stamp, values[43], values[44],
+                                                  angle, values[7], values)
+                self.update_odometry(stamp, values[43], values[44])
+
+    def poll_odometry(self, event=None):
+        """Timer callback feeding the odometry when there is no sensor stream"""
+        left_counts, right_counts = self.read_wheel_counts()
+        self.update_odometry(rospy.get_time(), left_counts, right_counts)
+
+    def update_odometry(self, stamp, left_counts, right_counts):
+        """Integrate one encoder reading of the physical left and right wheel"""
+        if self.last_wheel_counts is None:
+            self.last_wheel_counts = (left_counts, right_counts)
+            return
+        left_mm = count_delta(left_counts, self.last_wheel_counts[0]) * self.mm_per_count
+        right_mm = count_delta(right_counts, self.last_wheel_counts[1]) * self.mm_per_count
+        self.last_wheel_counts = (left_counts, right_counts)
+        last = self.odometry_pose
+        dist = (left_mm + right_mm) / 2.0
+        turn = (right_mm - left_mm) / self.wheel_base
+        # move along the average heading over the reading
+        heading = last.heading + turn / 2.0
+        pose = OdometryPose(stamp, last.x + dist * math.cos(heading),
+                            last.y + dist * math.sin(heading), last.heading + turn)
+        self.odometry_pose = pose
+        with self.odometry_lock:
+            self.odometry_poses.append(pose)
+        self.publish_odometry(pose, last, dist, turn)
+
+    def publish_odometry(self, pose, last, dist, turn):
+        odom = Odometry()
+        odom.header.stamp = rospy.Time.from_sec(pose.stamp)
+        odom.header.frame_id = 'odom'
+        odom.child_frame_id = 'base_link'
+        odom.pose.pose.position.x = pose.x / 1000.0
+        odom.pose.pose.position.y = pose.y / 1000.0
+        odom.pose.pose.orientation.z = math.sin(pose.heading / 2.0)
+        odom.pose.pose.orientation.w = math.cos(pose.heading / 2.0)
+        dt = pose.stamp - last.stamp
+        if last.stamp and dt > 0:
+            odom.twist.twist.linear.x = dist / 1000.0 / dt
+            odom.twist.twist.angular.z = turn / dt
+        self.odometry_publisher.publish(odom)
+
+    def pose_at(self, stamp):
+        """Return the odometry pose at stamp (seconds), the latest pose for 0"""
+        with self.odometry_lock:
+            history = list(self.odometry_poses)
+        if not stamp or not history:
+            return self.odometry_pose
+        return interpolate_pose(history, stamp)
+
+    def handle_requestPose(self, request):
+        pose = self.pose_at(request.stamp.to_sec())
+        return rospy.Time.from_sec(pose.stamp), pose.x, pose.y, pose.heading
 
     def handle_requestDrive(self, request):
         vel = request.velocity
         rot = request.rotation
         drive_command = self.make_drive_command(vel, rot)
-        self.connection.write(drive_command)
+        # newer than anything on driveCommand, don't let the writer replace it
+        self.velocity_command = None
+        self.write_drive(drive_command)
+        self.latency.record_since('serial write', request.pose_stamp)
         return []
 
-    def make_angle_request(self):
-        r_req = self.angle_struct.pack(142, 44)
-        l_req = self.angle_struct.pack(142, 43)
-        return l_req, r_req
-
-    def encoder_count_reset(self):
-        self.connection.write(self.left_encoder_request)
-        raw_left_counts = self.connection.read(2)
-        left_counts = struct.unpack('>H', raw_left_counts)
-        self.connection.write(self.right_encoder_request)
-        raw_right_counts = self.connection.read(2)
-        right_counts = struct.unpack('>H', raw_right_counts)
-        left_counts = left_counts[0]
-        right_counts = right_counts[0]
-        self.right_total = right_counts
-        self.left_total = left_counts
+    def query_sensors(self, packet_ids):
+        """
+        Return {packet id: value} for the given sensor packets.
+        Packets the sensor stream carries come from its latest sample, the
+        rest are read with one Query List exchange:
+        send [149] [number of packets] [packet id 1] ... [packet id n]
+        the robot answers with the packet data back to back in that order
+        """
+        packet_ids = tuple(packet_ids)
+        if self.stream_running:
+            deadline = rospy.get_time() + 1.0
+            while self.sensor_sample is None and rospy.get_time() < deadline:
+                rospy.sleep(self.sensor_period)
+            sample = self.sensor_sample
+            if sample is not None and all(packet_id in sample.packets for packet_id in packet_ids):
+                return dict((packet_id, sample.packets[packet_id]) for packet_id in packet_ids)
+        query_struct = self.query_structs.get(packet_ids)
+        if query_struct is None:
+            query_struct = struct.Struct('>' + ''.join(sensor_packet_formats[packet_id]
+                                                       for packet_id in packet_ids))
+            self.query_structs[packet_ids] = query_struct
+        query_cmd = struct.pack('>BB%dB' % len(packet_ids), 149, len(packet_ids), *packet_ids)
+        # the stream reader would eat the answer, so pause the stream meanwhile
+        self.stream_paused = True
+        try:
+            with self.serial_read_lock:
+                if self.stream_running:
+                    self.connection.write(struct.pack('>BB', 150, 0))
+                    rospy.sleep(2 * self.sensor_period)
+                    self.connection.flushInput()
+                self.connection.write(query_cmd)
+                raw_values = self.connection.read(query_struct.size)
+                if self.stream_running:
+                    self.stream_parser.buffer = bytearray()
+                    self.connection.write(struct.pack('>BB', 150, 1))
+        finally:
+            self.stream_paused = False
+        if len(raw_values) != query_struct.size:
+            raise IOError("Expected %d bytes of sensor data, got %d" %
+                          (query_struct.size, len(raw_values)))
+        return dict(zip(packet_ids, query_struct.unpack(raw_values)))
 
-    def handle_driveDist(self, request):
-        dist = request.distance
-        dist_mm = dist * 25.4   #mm per inch
-        dist_counts = dist_mm * (1/(72*math.pi)) * 508.8
-        vel = 300
-        rot = 0
-        drive_command = self.make_drive_command(vel, rot)
-        stop_command = self.make_drive_command(0, 0)
-        self.encoder_count_reset()
-        left_start = self.left_total
-        right_start = self.right_total
-        self.connection.write(drive_command)
-        while (((self.right_total - right_start) < dist_counts) 
-               and ((self.left_total - left_start) < dist_counts)):
-            rospy.sleep(0.1)
-            self.encoder_count_reset()
-        self.connection.write(stop_command)
-        return "Distance driven."
+    def handle_requestSensors(self, request):
+        packet_ids = list(bytearray(request.packet_ids))
+        values = self.query_sensors(packet_ids)
+        return [[values[packet_id] for packet_id in packet_ids]]
 
-    def handle_turnAngle(self, request):
-        ang_deg = request.degrees
-        ang_rad = ang_deg * (math.pi / 180)
-        mm_per_wheel = ang_rad * (235 / 2.0)
-        rot_per_wheel = mm_per_wheel * (1/(math.pi*72))
-        counts_per_wheel = rot_per_wheel * 508.8
-        self.encoder_count_reset()
-        right_start = self.right_total
-        left_start = self.left_total
-        drive_command = self.make_drive_command(0, 100)
-        stop_command = self.make_drive_command(0, 0)
-        self.connection.write(drive_command)
-        while (((self.right_total - right_start) < counts_per_wheel)
-               and ((left_start - self.left_total) < counts_per_wheel)):
-            rospy.sleep(0.1)
-            self.encoder_count_reset()
-        self.connection.write(stop_command)
-        return "Angle turned"
+    def read_wheel_counts(self):
+        values = self.query_sensors(self.wheel_packets)
+        return values[self.wheel_packets[0]], values[self.wheel_packets[1]]
 
-    def handle_requestAngle(self, request):
+    def run_move(self, left_mm, right_mm, max_speed, pose_stamp=None,
+                 feedback=None, preempted=None):
         """
-        send [142] [Packet ID]
-        for angle sensor, packet ID = 20
-        will return signed 16 bit value, high byte first
-        counterclockwise angles are positive
-        value is capped at -32768, +32767
+        Move the wheels left_mm and right_mm along a MoveProfile, returns
+        the (left, right) mm each wheel actually moved.
+        feedback is called with the (left, right) mm moved at every encoder
+        reading and the move stops early once preempted returns True.
         """
-        self.connection.write(self.left_encoder_request)
-        raw_left_counts = self.connection.read(2)
-        left_counts = struct.unpack('>H', raw_left_counts)
-        left_counts = left_counts[0]
-        self.connection.write(self.right_encoder_request)
-        raw_right_counts = self.connection.read(2)
-        right_counts = struct.unpack('>H', raw_right_counts)
-        right_counts = right_counts[0]
-        #print "left counts = ", left_counts
-        #print "left baseline = ", self.left_total
-        #print "right counts = ", right_counts
-        #print "right baseline = ", self.right_total
-        
-        if left_counts > self.left_total:
-            #print "left rollover detected"
-            left_diff = self.left_total + (self.encoder_max - left_counts)
-            #print "left diff = ", left_diff
+        length = max(abs(left_mm), abs(right_mm))
+        if length < self.move_tolerance:
+            return 0.0, 0.0
+        with self.motion_lock:
+            return self._run_move(left_mm, right_mm, max_speed, pose_stamp, feedback,
+                                  preempted)
+
+    def _run_move(self, left_mm, right_mm, max_speed, pose_stamp, feedback, preempted):
+        profile = MoveProfile(left_mm, right_mm, max_speed, rospy.get_time())
+        left_done = right_done = 0.0
+        last_left, last_right = self.read_wheel_counts()
+        while not rospy.is_shutdown():
+            left_counts, right_counts = self.read_wheel_counts()
+            left_done += count_delta(left_counts, last_left) * self.mm_per_count
+            right_done += count_delta(right_counts, last_right) * self.mm_per_count
+            last_left, last_right = left_counts, right_counts
+            speeds = profile.update(left_done, right_done, rospy.get_time())
+            if speeds is None:
+                break
+            if preempted is not None and preempted():
+                break
+            if feedback is not None:
+                feedback(left_done, right_done)
+            self.write_drive(self.make_wheel_command(*speeds))
+            self.latency.record_since('serial write', pose_stamp)
+            pose_stamp = None
+            rospy.sleep(self.sensor_period)
+        self.write_drive(self.make_wheel_command(0, 0))
+        # count whatever the robot coasts after the stop command
+        rospy.sleep(4 * self.sensor_period)
+        left_counts, right_counts = self.read_wheel_counts()
+        left_done += count_delta(left_counts, last_left) * self.mm_per_count
+        right_done += count_delta(right_counts, last_right) * self.mm_per_count
+        return left_done, right_done
+
+    def drive_dist(self, dist, pose_stamp=None, feedback=None, preempted=None):
+        """Drive dist inches straight, returns the inches driven"""
+        dist_mm = dist * 25.4   #mm per inch
+        if feedback is not None:
+            wheel_feedback = lambda left_mm, right_mm: feedback(
+                    (left_mm + right_mm) / 2.0 / 25.4)
         else:
-            left_diff = left_counts - self.left_total
-            #print "left diff = ", left_diff
-        if right_counts < self.right_total:
-            #print "right rollover detected"
-            right_diff = right_counts + (self.encoder_max - self.right_total)
-            #print "right diff = ", right_diff
+            wheel_feedback = None
+        left_mm, right_mm = self.run_move(dist_mm, dist_mm, self.drive_speed,
+                                          pose_stamp, wheel_feedback, preempted)
+        return (left_mm + right_mm) / 2.0 / 25.4
+
+    def turn_angle(self, ang_deg, pose_stamp=None, feedback=None, preempted=None):
+        """Turn in place, positive degrees turn clockwise (left wheel forward and
+        right wheel back), returns the degrees turned"""
+        ang_rad = ang_deg * (math.pi / 180)
+        mm_per_wheel = ang_rad * (self.wheel_base / 2.0)
+        to_degrees = lambda left_mm, right_mm: (
+                (left_mm - right_mm) / self.wheel_base * (180 / math.pi))
+        if feedback is not None:
+            wheel_feedback = lambda left_mm, right_mm: feedback(
+                    to_degrees(left_mm, right_mm))
         else:
-            right_diff = right_counts - self.right_total
-            #print "right diff = ", right_diff
+            wheel_feedback = None
+        left_mm, right_mm = self.run_move(mm_per_wheel, -mm_per_wheel, self.turn_speed,
+                                          pose_stamp, wheel_feedback, preempted)
+        return to_degrees(left_mm, right_mm)
 
-        left_dist = left_diff* (1/508.8) * (math.pi*72)
-        #print "left mm distance = ", left_dist
-        right_dist = right_diff* (1/508.8) * (math.pi*72)
-        #print "right mm distance = ", right_dist
+    def handle_driveDist(self, request):
+        achieved = self.drive_dist(request.distance, request.pose_stamp)
+        return "Distance driven.", achieved
+
+    def handle_turnAngle(self, request):
+        achieved = self.turn_angle(request.degrees, request.pose_stamp)
+        return "Angle turned", achieved
 
-        angle_rad = (right_dist - left_dist) / 235.0
-        #print "angle turned (radians) = ", angle_rad
-        angle_deg = angle_rad*(180/math.pi)
-        #print "angle turned (degrees) = ", angle_deg
+    def execute_motion(self, goal):
+        """Run a motion goal, publishing how far it got at every encoder reading"""
+        feedback = motionFeedback()
+        def publish_feedback(achieved):
+            feedback.achieved = achieved
+            feedback.remaining = amount - achieved
+            self.motion_server.publish_feedback(feedback)
+        preempted = self.motion_server.is_preempt_requested
+        amount = goal.amount
+        if goal.type == motionGoal.DRIVE:
+            achieved = self.drive_dist(amount, goal.pose_stamp, publish_feedback, preempted)
+            response = "Distance driven."
+        elif goal.type == motionGoal.TURN:
+            achieved = self.turn_angle(amount, goal.pose_stamp, publish_feedback, preempted)
+            response = "Angle turned"
+        elif goal.type == motionGoal.STRIKE:
+            amount = amount or self.strike_time
+            achieved = self.run_strike(amount, goal.pose_stamp, publish_feedback, preempted)
+            response = "Strike done"
+        else:
+            self.motion_server.set_aborted(motionResult("Unknown motion type %d" % goal.type, 0))
+            return
+        result = motionResult(response, achieved)
+        if preempted():
+            self.motion_server.set_preempted(result)
+        else:
+            self.motion_server.set_succeeded(result)
 
-        self.right_total = right_counts
-        self.left_total = left_counts
+    def handle_requestAngle(self, request):
+        """
+        Return the degrees turned clockwise since the last request, from the
+        odometry heading
+        """
+        heading = self.odometry_pose.heading
+        angle_deg = (self.angle_heading - heading) * (180 / math.pi)
+        self.angle_heading = heading
         return angle_deg
 
 if __name__ == "__main__":
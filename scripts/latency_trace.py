@@ -0,0 +1,61 @@
+# Rolling latency histograms, shared by the nodes to trace how old the camera
+# frame behind each objectPose and drive command is when it gets used.
+
+import rospy
+import numpy as np
+from collections import deque, OrderedDict
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+
+class LatencyHistogram():
+    """Rolling histogram of the last window latencies of one hop"""
+    bin_edges_ms = [0, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500, 1000]
+
+    def __init__(self, window):
+        self.samples = deque(maxlen=window)
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+
+    def values(self):
+        """Return the percentiles and bin counts as diagnostic KeyValues"""
+        samples = 1000 * np.array(list(self.samples))
+        if len(samples) == 0:
+            return [KeyValue('count', '0')]
+        counts = np.histogram(samples, bins=self.bin_edges_ms + [np.inf])[0]
+        # samples below the first edge (clock skew between hosts) go in the first bin
+        counts[0] += np.count_nonzero(samples < self.bin_edges_ms[0])
+        bins = ' '.join('%d+:%d' % (edge, count) for edge, count in zip(self.bin_edges_ms, counts))
+        return [KeyValue('count', str(len(samples))),
+                KeyValue('p50 (ms)', '%.1f' % np.percentile(samples, 50)),
+                KeyValue('p90 (ms)', '%.1f' % np.percentile(samples, 90)),
+                KeyValue('p99 (ms)', '%.1f' % np.percentile(samples, 99)),
+                KeyValue('max (ms)', '%.1f' % samples.max()),
+                KeyValue('histogram (ms)', bins)]
+
+class LatencyTracer():
+    """Latency histograms for a node's hops, published on /diagnostics unless
+    publish is False"""
+    def __init__(self, node_name, hops, window=500, period=1.0, publish=True):
+        self.node_name = node_name
+        self.histograms = OrderedDict((hop, LatencyHistogram(window)) for hop in hops)
+        if publish:
+            self.publisher = rospy.Publisher('/diagnostics', DiagnosticArray, queue_size=1)
+            self.timer = rospy.Timer(rospy.Duration(period), self.publish)
+
+    def record_since(self, hop, stamp):
+        """Record the time from stamp (the source camera frame) until now, zero stamps
+        mean the source is unknown and are skipped"""
+        if stamp is None or stamp.is_zero():
+            return
+        self.histograms[hop].record((rospy.Time.now() - stamp).to_sec())
+
+    def publish(self, event=None):
+        diagnostics = DiagnosticArray()
+        diagnostics.header.stamp = rospy.Time.now()
+        for hop, histogram in self.histograms.items():
+            diagnostics.status.append(DiagnosticStatus(
+                    level=DiagnosticStatus.OK,
+                    name='%s latency: %s' % (self.node_name, hop),
+                    message='camera frame to %s' % hop,
+                    values=histogram.values()))
+        self.publisher.publish(diagnostics)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+# Measure the speed and accuracy of the pyramid ball detector in camera_node
+# against the full resolution detector on recorded frames.
+#
+# usage: pyramid_tradeoff.py <directory of images | video file> [scale ...]
+
+import os
+import sys
+import time
+import cv2
+import numpy as np
+from camera_node import (ball_hsv_color, ball_threshold, openKernSizeForClose,
+                         closeKernSizeForFar, pyramidRefinePadding,
+                         threshold_image, find_object_in_mask,
+                         find_object_pyramid, calc_ball_dist)
+
+default_scales = [2, 3, 4, 6, 8]
+
+# function to read every frame from a directory of images or a video file
+def load_frames(path):
+    frames = []
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            frame = cv2.imread(os.path.join(path, name))
+            if frame is not None:
+                frames.append(frame)
+    else:
+        cap = cv2.VideoCapture(path)
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            frames.append(frame)
+        cap.release()
+    return frames
+
+# function to run a detector over every mask, returning boxes and seconds per mask
+def time_detector(masks, detect):
+    results = []
+    times = []
+    for mask in masks:
+        start = time.time()
+        results.append(detect(mask)[:4])
+        times.append(time.time() - start)
+    return results, times
+
+# function to compare detections against the full resolution detections
+def compare(reference, results):
+    agree = 0
+    width_errors = []
+    dist_errors = []
+    for ref, res in zip(reference, results):
+        if (ref[0] == -1) == (res[0] == -1):
+            agree += 1
+        if ref[0] != -1 and res[0] != -1:
+            width_errors.append(abs(res[2] - ref[2]))
+            dist_errors.append(abs(calc_ball_dist(res[2]) - calc_ball_dist(ref[2])))
+    if not width_errors:
+        width_errors = dist_errors = [0]
+    return (agree / float(len(reference)), np.mean(width_errors),
+            np.max(width_errors), np.mean(dist_errors), np.max(dist_errors))
+
+def main(path, scales):
+    frames = load_frames(path)
+    if not frames:
+        print "No frames found in", path
+        return
+    masks = []
+    for frame in frames:
+        hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+        masks.append(threshold_image(hsv, ball_hsv_color, ball_threshold))
+    reference, ref_times = time_detector(masks,
+            lambda mask: find_object_in_mask(mask, openKernSizeForClose,
+                                             closeKernSizeForFar))
+    ref_ms = 1000 * np.mean(ref_times)
+    print "%d frames, full resolution: %.2f ms/frame" % (len(frames), ref_ms)
+    print "scale   ms/frame  speedup  agree  width err (mean/max px)  dist err (mean/max in)"
+    for scale in scales:
+        results, times = time_detector(masks,
+                lambda mask: find_object_pyramid(mask, openKernSizeForClose,
+                                                 closeKernSizeForFar, scale,
+                                                 pyramidRefinePadding))
+        ms = 1000 * np.mean(times)
+        agree, width_mean, width_max, dist_mean, dist_max = compare(reference, results)
+        print "%5d  %9.2f  %7.1fx  %5.1f%%  %10.2f / %-10.2f  %9.2f / %-9.2f" % (
+                scale, ms, ref_ms / ms, 100 * agree, width_mean, width_max,
+                dist_mean, dist_max)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print "usage: pyramid_tradeoff.py <frame directory | video file> [scale ...]"
+        sys.exit(1)
+    scales = [int(arg) for arg in sys.argv[2:]] or default_scales
+    main(sys.argv[1], scales)
@@ -0,0 +1,558 @@
+#!/usr/bin/env python
+
+# Headless soccer simulator. A 2D field with the goal on the far end wall, a
+# Create 2 moved by differential drive kinematics and a ball that rolls,
+# bounces off the walls and is pushed by the robot. Frames of the field are
+# rendered through a pinhole camera in camera_node's ball and goal colors and
+# go through the unmodified CameraNode._process_image, whose objectPoses go to
+# an unmodified ControllerNode. drive_node is replaced by an in-process
+# stand-in for its motion action and driveCommand topic. Time is simulated,
+# so an episode runs as fast as the vision pipeline allows, and randomized
+# episodes are spread over processes. Needs no roscore, camera or robot.
+#
+# usage: soccer_simulator.py [--episodes 1000] [--processes N] [--timeout 60]
+#            [--seed 0] [--camera-latency 0.05] [--slip 0.02] [--noise 0.0]
+#            [--verbose]
+
+import os
+import sys
+import math
+import time
+import random
+import argparse
+import multiprocessing
+from collections import namedtuple, Counter
+import numpy as np
+import cv2
+import rospy
+from nav_msgs.msg import Odometry
+from actionlib_msgs.msg import GoalStatus
+from robotics_project.msg import motionGoal, motionFeedback, motionResult
+import camera_node
+from camera_node import CameraNode
+from controller_node import ControllerNode
+from latency_trace import LatencyTracer
+from drive_common import drive_settings, MoveProfile
+
+# the field in inches, x along its length with the goal centered on the
+# x = field_length wall. The ball and goal sizes are the ones camera_node's
+# width to distance fits (calc_ball_dist, _calcGoalDist) work out to with a
+# 60 degree wide 640 pixel camera
+field_length = 240.0
+field_width = 160.0
+goal_width = 38.5
+goal_height = 20.0
+ball_radius = 5.8
+robot_radius = 6.5
+camera_height = 10.0
+
+physics_period = 0.005
+frame_period = 0.04
+tick_period = 0.1           # ControllerNode's state machine tick
+
+# one episode's outcome, time is the seconds to score (or to the end of the
+# episode), wall_time the real seconds it took to simulate
+Episode = namedtuple('Episode', ['seed', 'scored', 'time', 'final_state', 'frames',
+                                 'wall_time'])
+
+# function to make rospy.get_time and rospy.Time.now return the simulated time
+def set_sim_time(seconds):
+    rospy.rostime.set_rostime_initialized(True)
+    rospy.rostime._set_rostime(rospy.Time.from_sec(seconds))
+
+# function to return the bgr8 color that camera_node sees as hsv color
+def hsv_to_bgr(hsv):
+    pixel = np.array([[hsv]], np.uint8)
+    return tuple(int(value) for value in cv2.cvtColor(pixel, cv2.COLOR_HSV2BGR)[0, 0])
+
+class SimRobot():
+    """Create 2 on the field, wheel speeds in mm/s and its pose in inches"""
+    wheel_base = drive_settings.wheel_base
+    wheel_accel = 1500.0        # mm/s^2 the wheels get to a new speed at
+
+    def __init__(self, x, y, heading, slip=0.0, rng=random):
+        self.x = x
+        self.y = y
+        self.heading = heading
+        self.command = (0.0, 0.0)   # requested left, right wheel mm/s
+        self.speeds = [0.0, 0.0]
+        self.wheel_mm = [0.0, 0.0]  # what the encoders count
+        # the ground moves a little more or less than each wheel turns, so
+        # the odometry drifts from the true pose
+        self.traction = (1 + rng.gauss(0, slip), 1 + rng.gauss(0, slip))
+        self.velocity = (0.0, 0.0)  # inches per second on the field
+        self.turn_rate = 0.0
+
+    def set_wheels(self, left, right):
+        # limited like DriveNode.make_wheel_command
+        self.command = (int(max(-500, min(500, left))), int(max(-500, min(500, right))))
+
+    def move(self, dt):
+        for wheel in (0, 1):
+            change = self.command[wheel] - self.speeds[wheel]
+            step = self.wheel_accel * dt
+            self.speeds[wheel] += max(-step, min(step, change))
+            self.wheel_mm[wheel] += self.speeds[wheel] * dt
+        left = self.speeds[0] * dt * self.traction[0]
+        right = self.speeds[1] * dt * self.traction[1]
+        dist = (left + right) / 2.0 / 25.4
+        turn = (right - left) / self.wheel_base
+        heading = self.heading + turn / 2.0
+        x = self.x + dist * math.cos(heading)
+        y = self.y + dist * math.sin(heading)
+        # the walls stop the robot, its wheels spin on
+        x = max(robot_radius, min(field_length - robot_radius, x))
+        y = max(robot_radius, min(field_width - robot_radius, y))
+        self.velocity = ((x - self.x) / dt, (y - self.y) / dt)
+        self.turn_rate = turn / dt
+        self.x, self.y = x, y
+        self.heading += turn
+
+class SimBall():
+    """Ball rolling on the field, positions in inches"""
+    friction = 4.0              # rolling deceleration, inches/s^2
+    restitution = 0.6
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+        self.velocity = (0.0, 0.0)
+
+    def speed(self):
+        return math.hypot(*self.velocity)
+
+    def move(self, dt):
+        speed = self.speed()
+        if speed > 0:
+            scale = max(0.0, speed - self.friction * dt) / speed
+            self.velocity = (self.velocity[0] * scale, self.velocity[1] * scale)
+        vx, vy = self.velocity
+        self.x += vx * dt
+        self.y += vy * dt
+        if self.x < ball_radius or self.x > field_length - ball_radius:
+            self.x = max(ball_radius, min(field_length - ball_radius, self.x))
+            vx = -self.restitution * vx
+        if self.y < ball_radius or self.y > field_width - ball_radius:
+            self.y = max(ball_radius, min(field_width - ball_radius, self.y))
+            vy = -self.restitution * vy
+        self.velocity = (vx, vy)
+
+    def in_goal(self):
+        return (self.x >= field_length - ball_radius - 0.1 and
+                abs(self.y - field_width / 2.0) <= goal_width / 2.0)
+
+    def push(self, robot):
+        """Move the ball out of the robot and bounce it off the robot's edge"""
+        dx = self.x - robot.x
+        dy = self.y - robot.y
+        dist = math.hypot(dx, dy)
+        overlap = robot_radius + ball_radius - dist
+        if overlap <= 0 or dist == 0:
+            return
+        nx, ny = dx / dist, dy / dist
+        self.x += nx * overlap
+        self.y += ny * overlap
+        # velocity of the robot's edge where it touches the ball
+        vx = robot.velocity[0] - robot.turn_rate * robot_radius * ny
+        vy = robot.velocity[1] + robot.turn_rate * robot_radius * nx
+        closing = (vx - self.velocity[0]) * nx + (vy - self.velocity[1]) * ny
+        if closing > 0:
+            self.velocity = (self.velocity[0] + (1 + self.restitution) * closing * nx,
+                             self.velocity[1] + (1 + self.restitution) * closing * ny)
+
+class SimCamera():
+    """Pinhole camera on the robot, renders the ball and goal in camera_node's colors"""
+    near = 6.0                  # inches, the goal is clipped to this depth
+
+    def __init__(self, width=640, height=480, horizontal_fov=60.0, noise=0.0, rng=None):
+        self.width = width
+        self.height = height
+        self.focal_length = width / 2.0 / math.tan(math.radians(horizontal_fov / 2.0))
+        self.center = (width / 2.0, height / 2.0)
+        self.noise = noise
+        self.random = rng or np.random.RandomState()
+        # a gray wall above the horizon and a green gray floor, neither near
+        # the ball or goal colors
+        self.background = np.empty((height, width, 3), np.uint8)
+        self.background[:height // 2] = (150, 150, 150)
+        self.background[height // 2:] = (70, 80, 75)
+        self.ball_color = hsv_to_bgr(camera_node.ball_hsv_color)
+        self.goal_color = hsv_to_bgr(camera_node.goal_hsv_color)
+
+    def to_camera(self, robot, x, y):
+        """(forward, left) inches of the field point x, y from the robot"""
+        dx = x - robot.x
+        dy = y - robot.y
+        cos_heading = math.cos(robot.heading)
+        sin_heading = math.sin(robot.heading)
+        return dx * cos_heading + dy * sin_heading, -dx * sin_heading + dy * cos_heading
+
+    def project(self, forward, left, height):
+        return (self.center[0] - self.focal_length * left / forward,
+                self.center[1] - self.focal_length * (height - camera_height) / forward)
+
+    def goal_corners(self, robot):
+        """Image corners of the goal clipped to the near plane, None when behind the camera"""
+        ends = [self.to_camera(robot, field_length, field_width / 2.0 + side * goal_width / 2.0)
+                for side in (-1, 1)]
+        (f1, l1), (f2, l2) = ends
+        if f1 < self.near and f2 < self.near:
+            return None
+        if f1 < self.near:
+            l1 += (self.near - f1) / (f2 - f1) * (l2 - l1)
+            f1 = self.near
+        elif f2 < self.near:
+            l2 += (self.near - f2) / (f1 - f2) * (l1 - l2)
+            f2 = self.near
+        corners = [self.project(f1, l1, 0.0), self.project(f1, l1, goal_height),
+                   self.project(f2, l2, goal_height), self.project(f2, l2, 0.0)]
+        return (f1 + f2) / 2.0, np.array(corners, np.int32)
+
+    def ball_extent(self, robot, ball):
+        """(depth, left, right, top, bottom) image extent of the ball, None
+        when it isn't in front of the camera. Off center the ball images
+        wider than at the center, like through the real lens"""
+        forward, left = self.to_camera(robot, ball.x, ball.y)
+        distance = math.hypot(forward, left)
+        if forward <= ball_radius or distance <= ball_radius:
+            return None
+        bearing = math.atan2(left, forward)
+        half_angle = math.asin(ball_radius / distance)
+        if abs(bearing) + half_angle >= math.pi / 2:
+            return None
+        u1 = self.center[0] - self.focal_length * math.tan(bearing + half_angle)
+        u2 = self.center[0] - self.focal_length * math.tan(bearing - half_angle)
+        v = self.project(forward, left, ball_radius)[1]
+        half_height = self.focal_length * ball_radius / forward
+        return forward, u1, u2, v - half_height, v + half_height
+
+    def render(self, robot, ball):
+        frame = self.background.copy()
+        shapes = []
+        goal = self.goal_corners(robot)
+        if goal is not None:
+            depth, corners = goal
+            shapes.append((depth, lambda: cv2.fillConvexPoly(frame, corners, self.goal_color)))
+        ball_box = self.ball_extent(robot, ball)
+        if ball_box is not None:
+            depth, left, right, top, bottom = ball_box
+            if right > 0 and left < self.width:
+                center = (int(round((left + right) / 2.0)), int(round((top + bottom) / 2.0)))
+                axes = (int(round((right - left) / 2.0)), int(round((bottom - top) / 2.0)))
+                shapes.append((depth, lambda: cv2.ellipse(frame, center, axes, 0, 0, 360,
+                                                          self.ball_color, -1)))
+        # the nearer object hides the farther one
+        for depth, draw in sorted(shapes, key=lambda shape: -shape[0]):
+            draw()
+        if self.noise:
+            noise = self.random.normal(0, self.noise, frame.shape)
+            frame = np.clip(frame + noise, 0, 255).astype(np.uint8)
+        return frame
+
+class DelayedPublisher():
+    """Stand-in for camera_node's objectPose publisher, each message is
+    delivered latency seconds after it is published"""
+    def __init__(self, latency):
+        self.latency = latency
+        self.queue = []
+
+    def publish(self, message):
+        self.queue.append((rospy.get_time() + self.latency, message))
+
+    def due(self, now):
+        messages = [message for deliver, message in self.queue if deliver <= now]
+        self.queue = [(deliver, message) for deliver, message in self.queue if deliver > now]
+        return messages
+
+class SimDriveNode():
+    """
+    Stand-in for drive_node, used as ControllerNode's driveCommand publisher
+    and motion action client. Motion goals run DriveNode's closed loop move
+    and strike one encoder reading per step, driveCommands are written at
+    DriveNode's command rate and stop the robot when they go stale
+    """
+    def __init__(self, robot, settings=drive_settings):
+        self.robot = robot
+        self.settings = settings
+        self.velocity_command = None    # (velocity, rotation, received)
+        self.motion = None              # generator running the current goal
+        self.goal = None
+        self.feedback_cb = None
+        self.done_cb = None
+        self.response = ''
+        self.achieved = 0.0
+        self.next_step = 0.0
+        self.next_write = 0.0
+
+    def publish(self, command):
+        self.velocity_command = (command.velocity, command.rotation, rospy.get_time())
+
+    def wait_for_server(self, timeout=None):
+        return True
+
+    def send_goal(self, goal, feedback_cb=None, done_cb=None):
+        # a new goal preempts the running one, like the SimpleActionServer
+        self.cancel_goal()
+        self.goal = goal
+        self.feedback_cb = feedback_cb
+        self.done_cb = done_cb
+        self.achieved = 0.0
+        if goal.type == motionGoal.DRIVE:
+            self.motion = self.drive_dist(goal.amount)
+            self.response = "Distance driven."
+        elif goal.type == motionGoal.TURN:
+            self.motion = self.turn_angle(goal.amount)
+            self.response = "Angle turned"
+        elif goal.type == motionGoal.STRIKE:
+            self.motion = self.run_strike(goal.amount or self.settings.strike_time)
+            self.response = "Strike done"
+        else:
+            self.finish(GoalStatus.ABORTED, "Unknown motion type %d" % goal.type)
+            return
+        self.next_step = rospy.get_time()
+
+    def cancel_goal(self):
+        if self.motion is not None:
+            self.robot.set_wheels(0, 0)
+            self.finish(GoalStatus.PREEMPTED, self.response)
+
+    def finish(self, status, response):
+        done_cb = self.done_cb
+        self.motion = None
+        self.done_cb = None
+        if done_cb is not None:
+            done_cb(status, motionResult(response, self.achieved))
+
+    def step(self, now):
+        if now >= self.next_write:
+            self.write_velocity_command(now)
+            self.next_write += 1.0 / self.settings.command_rate
+        if self.motion is not None and now >= self.next_step:
+            self.next_step += self.settings.sensor_period
+            try:
+                next(self.motion)
+            except StopIteration:
+                self.finish(GoalStatus.SUCCEEDED, self.response)
+
+    def write_velocity_command(self, now):
+        if self.velocity_command is None:
+            return
+        velocity, rotation, received = self.velocity_command
+        stale = now - received > self.settings.command_timeout
+        # motion goals own the wheels while they run
+        if self.motion is None:
+            if stale:
+                self.robot.set_wheels(0, 0)
+            else:
+                self.robot.set_wheels(velocity + rotation, velocity - rotation)
+        if stale:
+            self.velocity_command = None
+
+    def send_feedback(self):
+        if self.feedback_cb is not None:
+            self.feedback_cb(motionFeedback(self.achieved, self.goal.amount - self.achieved))
+
+    def run_move(self, left_mm, right_mm, max_speed, to_achieved):
+        """DriveNode._run_move on the simulated encoders, yielding at every
+        encoder reading, to_achieved turns the (left, right) mm moved into
+        the goal's units"""
+        if max(abs(left_mm), abs(right_mm)) < self.settings.move_tolerance:
+            return
+        profile = MoveProfile(left_mm, right_mm, max_speed, rospy.get_time(), self.settings)
+        start_left, start_right = self.robot.wheel_mm
+        while True:
+            left_done = self.robot.wheel_mm[0] - start_left
+            right_done = self.robot.wheel_mm[1] - start_right
+            self.achieved = to_achieved(left_done, right_done)
+            speeds = profile.update(left_done, right_done, rospy.get_time())
+            if speeds is None:
+                break
+            self.send_feedback()
+            self.robot.set_wheels(*speeds)
+            yield
+        self.robot.set_wheels(0, 0)
+        # count whatever the robot coasts after the stop command
+        for _ in range(4):
+            yield
+        self.achieved = to_achieved(self.robot.wheel_mm[0] - start_left,
+                                    self.robot.wheel_mm[1] - start_right)
+
+    def drive_dist(self, dist):
+        dist_mm = dist * 25.4
+        return self.run_move(dist_mm, dist_mm, self.settings.drive_speed,
+                             lambda left_mm, right_mm: (left_mm + right_mm) / 2.0 / 25.4)
+
+    def turn_angle(self, ang_deg):
+        # positive degrees turn clockwise, left wheel forward
+        mm_per_wheel = math.radians(ang_deg) * self.settings.wheel_base / 2.0
+        return self.run_move(mm_per_wheel, -mm_per_wheel, self.settings.turn_speed,
+                             lambda left_mm, right_mm: math.degrees(
+                                     (left_mm - right_mm) / self.settings.wheel_base))
+
+    def run_strike(self, duration):
+        start = rospy.get_time()
+        self.robot.set_wheels(self.settings.strike_speed, self.settings.strike_speed)
+        elapsed = 0.0
+        while elapsed < duration:
+            self.achieved = elapsed
+            self.send_feedback()
+            yield
+            elapsed = rospy.get_time() - start
+        self.robot.set_wheels(0, 0)
+        self.achieved = min(elapsed, duration)
+
+class SimOdometry():
+    """DriveNode's odometry from the robot's encoders, as nav_msgs/Odometry"""
+    def __init__(self, robot):
+        self.robot = robot
+        self.last_wheel_mm = list(robot.wheel_mm)
+        self.x = self.y = self.heading = 0.0    # mm and radians from the start pose
+
+    def update(self, stamp):
+        left = self.robot.wheel_mm[0] - self.last_wheel_mm[0]
+        right = self.robot.wheel_mm[1] - self.last_wheel_mm[1]
+        self.last_wheel_mm = list(self.robot.wheel_mm)
+        dist = (left + right) / 2.0
+        turn = (right - left) / self.robot.wheel_base
+        heading = self.heading + turn / 2.0
+        self.x += dist * math.cos(heading)
+        self.y += dist * math.sin(heading)
+        self.heading += turn
+        odom = Odometry()
+        odom.header.stamp = rospy.Time.from_sec(stamp)
+        odom.header.frame_id = 'odom'
+        odom.child_frame_id = 'base_link'
+        odom.pose.pose.position.x = self.x / 1000.0
+        odom.pose.pose.position.y = self.y / 1000.0
+        odom.pose.pose.orientation.z = math.sin(self.heading / 2.0)
+        odom.pose.pose.orientation.w = math.cos(self.heading / 2.0)
+        return odom
+
+# function to place the robot and the ball at random, the ball away from the
+# walls and the robot
+def place(rng, slip):
+    robot = SimRobot(rng.uniform(24, field_length - 60), rng.uniform(24, field_width - 24),
+                     rng.uniform(-math.pi, math.pi), slip, rng)
+    while True:
+        ball = SimBall(rng.uniform(36, field_length - 36), rng.uniform(24, field_width - 24))
+        if math.hypot(ball.x - robot.x, ball.y - robot.y) > 36:
+            return robot, ball
+
+# function to run one seeded episode, task is (seed, args)
+def run_episode(task):
+    seed, args = task
+    wall_start = time.time()
+    rng = random.Random(seed)
+    robot, ball = place(rng, args.slip)
+    # stamps of 0 mean "latest" to the world model, so time starts at 1
+    start = now = 1.0
+    set_sim_time(now)
+    sim_camera = SimCamera(noise=args.noise, rng=np.random.RandomState(seed))
+    camera = CameraNode(start_node=False)
+    publisher = DelayedPublisher(args.camera_latency)
+    camera.objectPosePub = publisher
+    camera.latency = LatencyTracer('camera_node', ['objectPose published'], publish=False)
+    controller = ControllerNode(start_node=False)
+    drive = SimDriveNode(robot)
+    drive.next_write = now
+    controller.drive_publisher = drive
+    controller.motion_client = drive
+    odometry = SimOdometry(robot)
+    controller.machine.start()
+    next_tick = next_odometry = next_frame = now
+    frames = 0
+    scored = False
+    while now - start < args.timeout:
+        set_sim_time(now)
+        for pose in publisher.due(now):
+            controller.handle_incoming_pose(pose)
+        if now >= next_tick:
+            controller.machine.handle_event('tick')
+            next_tick += tick_period
+        while controller.queued_events:
+            controller.machine.handle_event(controller.queued_events.pop(0))
+        drive.step(now)
+        robot.move(physics_period)
+        ball.move(physics_period)
+        ball.push(robot)
+        now += physics_period
+        if ball.in_goal():
+            scored = True
+            break
+        # once the controller is done there is only the ball left to watch
+        if controller.machine.finished.is_set():
+            if drive.motion is None and ball.speed() < 0.5:
+                break
+            continue
+        set_sim_time(now)
+        if now >= next_odometry:
+            controller.world.update_odometry(odometry.update(now))
+            next_odometry += drive_settings.sensor_period
+        if now >= next_frame:
+            camera._process_image(sim_camera.render(robot, ball), rospy.Time.from_sec(now))
+            frames += 1
+            next_frame += frame_period
+    return Episode(seed, scored, now - start, controller.machine.state.name, frames,
+                   time.time() - wall_start)
+
+def init_worker(verbose):
+    # the controller prints every state change and plan, not worth seeing
+    # for thousands of episodes
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+    # the episodes already run in parallel, and a wall clock budget would
+    # make the vision depend on how busy the machine is
+    camera_node.useParallelDetection = False
+    camera_node.useProcessingBudget = False
+
+def print_report(episodes, wall_time, processes):
+    scored = [episode for episode in episodes if episode.scored]
+    print "%d episodes, %d scored (%.1f%%)" % (len(episodes), len(scored),
+                                               100.0 * len(scored) / len(episodes))
+    if scored:
+        seconds = np.array([episode.time for episode in scored])
+        print "time to score   mean %.2f  p50 %.2f  p90 %.2f  p99 %.2f  max %.2f s" % (
+                seconds.mean(), np.percentile(seconds, 50), np.percentile(seconds, 90),
+                np.percentile(seconds, 99), seconds.max())
+    failed = Counter(episode.final_state for episode in episodes if not episode.scored)
+    if failed:
+        print "missed, by final state:", ', '.join('%s %d' % item for item in
+                                                    failed.most_common())
+    sim_time = sum(episode.time for episode in episodes)
+    frames = sum(episode.frames for episode in episodes)
+    print "%.0f simulated s in %.1f s on %d processes (%.1fx real time), %.0f frames/s" % (
+            sim_time, wall_time, processes, sim_time / wall_time, frames / wall_time)
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless soccer simulator')
+    parser.add_argument('--episodes', type=int, default=1000, help='episodes to run')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+                        help='worker processes')
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help='simulated seconds before an episode counts as missed')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first episode')
+    parser.add_argument('--camera-latency', type=float, default=0.05,
+                        help='seconds from a frame to its objectPose reaching the controller')
+    parser.add_argument('--slip', type=float, default=0.02,
+                        help='standard deviation of each wheel\'s traction error')
+    parser.add_argument('--noise', type=float, default=0.0,
+                        help='standard deviation of the pixel noise added to frames')
+    parser.add_argument('--verbose', action='store_true',
+                        help='let the controller print as it plays')
+    args = parser.parse_args()
+
+    tasks = [(seed, args) for seed in range(args.seed, args.seed + args.episodes)]
+    start = time.time()
+    pool = multiprocessing.Pool(args.processes, init_worker, (args.verbose,))
+    episodes = []
+    try:
+        for episode in pool.imap_unordered(run_episode, tasks):
+            episodes.append(episode)
+            if len(episodes) % 100 == 0:
+                print "%d/%d episodes" % (len(episodes), args.episodes)
+    finally:
+        pool.terminate()
+    print_report(episodes, time.time() - start, args.processes)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# Small event driven state machine for controller_node. Nothing polls:
+# callbacks (objectPose, motion goals finishing) and a tick timer call
+# handle_event, which runs the current state's during action and checks its
+# exit conditions in order.
+
+import rospy
+import threading
+from collections import OrderedDict
+
+class State():
+    """
+    One state of the machine. enter runs once when the state is entered,
+    during on every event while in it, exits is a list of (condition, next
+    state name) where the first condition returning True fires, and timeout
+    is (seconds, next state name) or None. A state with no exits is final.
+    """
+    def __init__(self, name, enter=None, during=None, exits=(), timeout=None):
+        self.name = name
+        self.enter = enter
+        self.during = during
+        self.exits = list(exits)
+        self.timeout = timeout
+
+class StateMachine():
+    """Runs States on events, logging the time spent in each one. Without a
+    tick_period the owner sends the 'tick' events itself"""
+    def __init__(self, states, start, tick_period=0.1):
+        self.states = OrderedDict((state.name, state) for state in states)
+        self.start_name = start
+        self.tick_period = tick_period
+        self.state = None
+        self.entered = None
+        self.started = None
+        self.timings = []
+        self.lock = threading.RLock()
+        self.finished = threading.Event()
+        self.timer = None
+
+    def start(self):
+        with self.lock:
+            self.started = rospy.get_time()
+            self.transition(self.start_name)
+            # ticks drive timeouts and during actions when no other events come in
+            if self.tick_period and not self.finished.is_set():
+                self.timer = rospy.Timer(rospy.Duration(self.tick_period),
+                                         lambda event: self.handle_event('tick'))
+
+    def wait(self, timeout=None):
+        """Block until a final state is reached, returns False on timeout"""
+        self.finished.wait(timeout)
+        return self.finished.is_set()
+
+    def transition(self, name):
+        now = rospy.get_time()
+        if self.state is not None:
+            elapsed = now - self.entered
+            self.timings.append((self.state.name, elapsed))
+            print "state %s -> %s after %.2f s" % (self.state.name, name, elapsed)
+        self.state = self.states[name]
+        self.entered = now
+        if self.state.enter is not None:
+            self.state.enter()
+        if not self.state.exits and self.state.timeout is None:
+            self.finish()
+
+    def handle_event(self, event):
+        """Run the current state for one event, following exits until one holds still"""
+        with self.lock:
+            if self.state is None or self.finished.is_set():
+                return
+            if self.state.during is not None:
+                self.state.during()
+            # a state can be left straight after it is entered, follow those
+            # transitions too, but at most once per state so loops can't spin
+            visited = set()
+            while self.state.name not in visited and not self.finished.is_set():
+                visited.add(self.state.name)
+                next_name = self.next_state()
+                if next_name is None:
+                    break
+                self.transition(next_name)
+
+    def next_state(self):
+        for condition, next_name in self.state.exits:
+            if condition():
+                return next_name
+        if self.state.timeout is not None:
+            seconds, next_name = self.state.timeout
+            if rospy.get_time() - self.entered > seconds:
+                print "state %s timed out" % self.state.name
+                return next_name
+        return None
+
+    def finish(self):
+        if self.timer is not None:
+            self.timer.shutdown()
+        total = rospy.get_time() - self.started
+        totals = OrderedDict()
+        for name, elapsed in self.timings:
+            totals[name] = totals.get(name, 0.0) + elapsed
+        print "finished in %s after %.2f s" % (self.state.name, total)
+        for name, elapsed in totals.items():
+            print "  %-14s %7.2f s  %5.1f%%" % (name, elapsed, 100 * elapsed / max(total, 1e-6))
+        self.finished.set()
@@ -7,7 +7,6 @@ port = '/dev/ttyUSB0'
 baudrate=115200
 timeout=1
 connection = serial.Serial(port, baudrate=baudrate, timeout=1)
-encoder_max = 65535
 
 def make_drive_command(vel, rot):
     vl = sorted([-500, vel + rot, 500])[1]
@@ -41,44 +40,37 @@ def read_ang():
     angle = struct.unpack('>h', read_vals)
     return angle, read_vals
 
-r_req = rcom('142 44')
-l_req = rcom('142 43')
+# query list of both encoders, the robot answers left (43) then right (44)
+encoders_req = struct.pack('>BBBB', 149, 2, 43, 44)
+encoders_struct = struct.Struct('>HH')
+
+def read_encoders():
+    connection.write(encoders_req)
+    return encoders_struct.unpack(connection.read(encoders_struct.size))
+
+# function to return the signed change between two 16 bit encoder readings,
+# the counts wrap around at 65535 in either direction
+def count_delta(new, old):
+    delta = (new - old) & 0xFFFF
+    if delta >= 0x8000:
+        delta -= 0x10000
+    return delta
 
 left_total, right_total = 0, 0
 
 def encoder_count_reset():
     global left_total, right_total
-    connection.write(l_req)
-    raw_left_counts = connection.read(2)
-    left_counts = struct.unpack('>H', raw_left_counts)
-    connection.write(r_req)
-    raw_right_counts = connection.read(2)
-    right_counts = struct.unpack('>H', raw_right_counts)
-    left_counts = left_counts[0]
-    right_counts = right_counts[0]
+    left_counts, right_counts = read_encoders()
     right_total = right_counts
     left_total = left_counts
     return left_total, right_total
 
 def calc_angle():
     global left_total, right_total
-    connection.write(l_req)
-    raw_left_counts = connection.read(2)
-    left_counts = struct.unpack('>H', raw_left_counts)
-    left_counts = left_counts[0]
-    connection.write(r_req)
-    raw_right_counts = connection.read(2)
-    right_counts = struct.unpack('>H', raw_right_counts)
-    right_counts = right_counts[0]
-    
-    if right_counts > right_total:
-        right_diff = right_total + (encoder_max - right_counts)
-    else:
-        right_diff = right_counts - right_total
-    if left_counts < left_total:
-        left_diff = left_counts + (encoder_max - left_total)
-    else:
-        left_diff = left_counts - left_total
+    left_counts, right_counts = read_encoders()
+
+    right_diff = count_delta(right_counts, right_total)
+    left_diff = count_delta(left_counts, left_total)
 
     left_dist = left_diff* (1/508.8) * (math.pi*72)
     right_dist = right_diff* (1/508.8) * (math.pi*72)
@@ -0,0 +1,125 @@
+# World model for controller_node. Every objectPose sighting of the ball or
+# the goal is placed in the odometry frame using the robot pose at the
+# camera frame's stamp, so estimates stay usable after the robot has moved
+# and while the object is out of view.
+
+import math
+import threading
+from collections import deque, namedtuple
+from drive_common import OdometryPose, interpolate_pose
+
+# fused position of an object in the odometry frame (inches), variance in
+# square inches as of stamp, sightings is how many objectPoses went into it
+ObjectEstimate = namedtuple('ObjectEstimate', ['stamp', 'x', 'y', 'variance', 'sightings'])
+
+# an estimate seen from the robot's current pose: x forward and y to the left
+# (inches), bearing in degrees counterclockwise from straight ahead, age in
+# seconds since the last sighting and variance grown to now
+ObjectView = namedtuple('ObjectView', ['x', 'y', 'distance', 'bearing', 'age', 'variance',
+                                       'sightings'])
+
+class WorldModel():
+    """Confidence weighted ball and goal positions from objectPose and odometry"""
+    # how fast the position variance grows while an object isn't seen
+    # (square inches per second), the ball gets pushed around, the goal only
+    # drifts with the odometry
+    process_noise = {'ball': 4.0, 'goal': 0.25}
+    # measurement noise when objectPose carries no covariance
+    center_sigma_px = 3.0
+    distance_sigma = {'ball': 2.0, 'goal': 6.0}
+
+    def __init__(self, image_width=640, horizontal_fov=60.0, history=5.0, pose_rate=66):
+        self.image_center_x = image_width / 2.0
+        self.focal_length = self.image_center_x / math.tan(math.radians(horizontal_fov / 2.0))
+        self.poses = deque(maxlen=int(history * pose_rate))
+        self.pose = None
+        self.lock = threading.Lock()
+        self.estimates = {'ball': None, 'goal': None}
+
+    def update_odometry(self, odom):
+        """Odometry callback, keeps the recent robot poses in inches"""
+        orientation = odom.pose.pose.orientation
+        heading = 2 * math.atan2(orientation.z, orientation.w)
+        # the quaternion wraps the heading, unwrap it again so interpolate_pose
+        # never interpolates across a jump of 2 pi
+        if self.pose is not None:
+            heading += 2 * math.pi * round((self.pose.heading - heading) / (2 * math.pi))
+        pose = OdometryPose(odom.header.stamp.to_sec(),
+                            odom.pose.pose.position.x * 1000 / 25.4,
+                            odom.pose.pose.position.y * 1000 / 25.4,
+                            heading)
+        with self.lock:
+            self.poses.append(pose)
+        self.pose = pose
+
+    def pose_at(self, stamp):
+        with self.lock:
+            history = list(self.poses)
+        if not history:
+            return OdometryPose(stamp, 0.0, 0.0, 0.0)
+        if not stamp:
+            return history[-1]
+        return interpolate_pose(history, stamp)
+
+    def update_pose(self, objectPose):
+        """objectPose callback, fuses the ball and goal sightings into the estimates"""
+        stamp = objectPose.header.stamp.to_sec()
+        robot = self.pose_at(stamp)
+        if objectPose.ball_in_view and objectPose.ball_distance > 0:
+            center_sigma = self.center_sigma_px
+            distance_sigma = self.distance_sigma['ball']
+            if len(objectPose.ball_covariance) == 36:
+                center_sigma = math.sqrt(objectPose.ball_covariance[0])
+                distance_sigma = math.sqrt(objectPose.ball_covariance[14])
+            self.fuse('ball', robot, stamp, objectPose.ball_distance,
+                      objectPose.ball_center_x, center_sigma, distance_sigma)
+        if objectPose.goal_in_view and objectPose.goal_distance > 0:
+            self.fuse('goal', robot, stamp, objectPose.goal_distance,
+                      objectPose.goal_center_x, self.center_sigma_px,
+                      self.distance_sigma['goal'])
+
+    def bearing(self, center_x):
+        """Radians counterclockwise from straight ahead to pixel column center_x"""
+        return math.atan2(self.image_center_x - center_x, self.focal_length)
+
+    def fuse(self, name, robot, stamp, distance, center_x, center_sigma, distance_sigma):
+        bearing = self.bearing(center_x)
+        heading = robot.heading + bearing
+        x = robot.x + distance * math.cos(heading)
+        y = robot.y + distance * math.sin(heading)
+        bearing_sigma = center_sigma / self.focal_length
+        variance = distance_sigma ** 2 + (distance * bearing_sigma) ** 2
+        last = self.estimates[name]
+        if last is not None:
+            last_variance = self.grown_variance(name, last, stamp)
+            gain = last_variance / (last_variance + variance)
+            x = last.x + gain * (x - last.x)
+            y = last.y + gain * (y - last.y)
+            variance = last_variance * variance / (last_variance + variance)
+            sightings = last.sightings + 1
+        else:
+            sightings = 1
+        # one tuple assignment, so readers never see half an update
+        self.estimates[name] = ObjectEstimate(stamp, x, y, variance, sightings)
+
+    def grown_variance(self, name, estimate, stamp):
+        return estimate.variance + self.process_noise[name] * max(0.0, stamp - estimate.stamp)
+
+    def forget(self, name):
+        self.estimates[name] = None
+
+    def view(self, name, now):
+        """The estimate of name seen from the current pose, None if never seen"""
+        estimate = self.estimates[name]
+        if estimate is None:
+            return None
+        robot = self.pose or OdometryPose(now, 0.0, 0.0, 0.0)
+        dx = estimate.x - robot.x
+        dy = estimate.y - robot.y
+        cos_heading = math.cos(robot.heading)
+        sin_heading = math.sin(robot.heading)
+        x = dx * cos_heading + dy * sin_heading
+        y = -dx * sin_heading + dy * cos_heading
+        return ObjectView(x, y, math.hypot(x, y), math.degrees(math.atan2(y, x)),
+                          now - estimate.stamp, self.grown_variance(name, estimate, now),
+                          estimate.sightings)